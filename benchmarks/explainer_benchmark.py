@@ -0,0 +1,244 @@
+"""
+Offline benchmark of the AnkiExplainer.
+
+Runs the whole explainer.py flow against a local AnkiConnect stand-in (an
+HTTP server serving synthetic decks, in its own process) and a
+deterministic fake LLM and embedding model with configurable latency, then
+reports the throughput, the peak RSS and the per-stage timings recorded in
+the metrics file of the run.
+
+Usage:
+    python benchmarks/explainer_benchmark.py --n_cards=10000 --llm_latency=0.05 --max_concurrency=16
+"""
+import hashlib
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from types import SimpleNamespace
+
+import fire
+
+REPO_DIR = Path(__file__).absolute().parent.parent
+
+DATASET = [
+    "You explain flashcards to a medical student. Be concise.",
+    "Body: The {{c1::heart}} has four chambers.",
+    "The heart has two atria and two ventricles.",
+    "Body: {{c1::Insulin}} lowers blood glucose.",
+    "Insulin is secreted by the beta cells of the pancreas.",
+    "Body: The {{c1::femur}} is the longest bone.",
+    "The femur is the thigh bone.",
+]
+
+
+def make_cards(n_cards, n_decks):
+    "synthetic cardsInfo, one card per note"
+    cards = {}
+    for i in range(n_cards):
+        cid = 1_000_000 + i
+        cards[cid] = {
+            "cardId": cid,
+            "note": 2_000_000 + i,
+            "deckName": f"Benchmark::Deck{i % n_decks:03d}",
+            "ord": 0,
+            "type": 2,
+            "fields": {
+                "Body": {
+                    "value": (
+                        f"<b>Fact #{i}</b>: the {{{{c1::answer {i}}}}} is "
+                        f"related to <i>topic {i % 97}</i>&nbsp;and more.<br>"
+                    ),
+                    "order": 0,
+                },
+                "AnkiExplainer": {"value": "", "order": 1},
+            },
+        }
+    return cards
+
+
+def serve_anki(port, n_cards, n_decks, ready):
+    "AnkiConnect stand-in, to run in its own process"
+    cards = make_cards(n_cards, n_decks)
+
+    def handle(action, params):
+        if action == "findCards":
+            return list(cards.keys())
+        elif action == "cardsInfo":
+            return [cards[c] for c in params["cards"]]
+        elif action == "multi":
+            return [
+                {"result": handle(a["action"], a.get("params", {})), "error": None}
+                for a in params["actions"]
+            ]
+        elif action in ["updateNoteFields", "addTags", "removeTags", "sync"]:
+            return None
+        raise ValueError(f"Unsupported action '{action}'")
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            try:
+                response = {"result": handle(request["action"], request.get("params", {})), "error": None}
+            except Exception as err:
+                response = {"result": None, "error": str(err)}
+            body = json.dumps(response).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    ready.set()
+    server.serve_forever()
+
+
+def anki_client(url):
+    "minimal AnkiConnect client, same signature as utils.anki.anki"
+    def anki(action, **params):
+        request = json.dumps({"action": action, "version": 6, "params": params}).encode()
+        with urllib.request.urlopen(url, request) as r:
+            response = json.load(r)
+        if response["error"] is not None:
+            raise Exception(response["error"])
+        return response["result"]
+    return anki
+
+
+def fake_chat(latency):
+    "deterministic LLM, answers after latency seconds"
+    def chat(messages, model, **kwargs):
+        time.sleep(latency)
+        content = messages[-1]["content"]
+        digest = hashlib.sha256(content.encode()).hexdigest()[:12]
+        answer = f"* KEY point {digest}: {content[:80]}"
+        return {
+            "choices": [{"message": {"role": "assistant", "content": answer}}],
+            "usage": {
+                "prompt_tokens": sum(len(m["content"]) // 4 for m in messages),
+                "completion_tokens": len(answer) // 4,
+            },
+        }
+    return chat
+
+
+def fake_embedding(latency, dim=64):
+    "deterministic embedding model, answers after latency seconds per batch"
+    def embedding(model, input, **kwargs):
+        time.sleep(latency)
+        data = []
+        for text in input:
+            seed = hashlib.sha256(text.encode()).digest()
+            data.append({"embedding": [(seed[i % 32] - 128) / 128 for i in range(dim)]})
+        return SimpleNamespace(data=data)
+    return embedding
+
+
+def main(
+    n_cards: int = 10000,
+    n_decks: int = 20,
+    llm_latency: float = 0.05,
+    embedding_latency: float = 0.01,
+    max_concurrency: int = 16,
+    page_size: int = 1000,
+    anki_batch_size: int = 50,
+    format_workers: int = 1,
+    use_cache: bool = False,
+    port: int = 18765,
+):
+    """
+    Parameters
+    ----------
+    n_cards: int, default 10000
+        number of synthetic cards served by the AnkiConnect stand-in
+    n_decks: int, default 20
+        number of decks the cards are spread over
+    llm_latency: float, default 0.05
+        seconds the fake LLM waits before answering
+    embedding_latency: float, default 0.01
+        seconds the fake embedding model waits per batch
+    max_concurrency, page_size, anki_batch_size, format_workers, use_cache
+        passed to AnkiExplainer
+    port: int, default 18765
+        port of the AnkiConnect stand-in
+    """
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(
+        target=serve_anki, args=(port, n_cards, n_decks, ready), daemon=True
+    )
+    server.start()
+    ready.wait()
+
+    # the explainer writes its databases relative to the working directory
+    workdir = Path(tempfile.mkdtemp(prefix="explainer_benchmark_"))
+    dataset_path = workdir / "dataset.txt"
+    dataset_path.write_text("\n----\n".join(DATASET))
+    os.chdir(workdir)
+    sys.path.insert(0, str(REPO_DIR))
+
+    import explainer
+    import utils.anki_batch
+    import utils.embeddings
+
+    anki = anki_client(f"http://127.0.0.1:{port}")
+    explainer.anki = anki
+    utils.anki_batch.anki = anki
+    explainer.sync_anki = lambda: anki("sync")
+    explainer.addtags = lambda nid, tags: anki("addTags", notes=[nid], tags=tags)
+    explainer.removetags = lambda nid, tags: anki("removeTags", notes=[nid], tags=tags)
+    explainer.chat = fake_chat(llm_latency)
+    utils.embeddings.litellm.embedding = fake_embedding(embedding_latency)
+
+    t0 = time.time()
+    try:
+        explainer.AnkiExplainer(
+            query="deck:Benchmark",
+            field_names="Body",
+            dataset_path=str(dataset_path),
+            do_sync=False,
+            max_concurrency=max_concurrency,
+            page_size=page_size,
+            anki_batch_size=anki_batch_size,
+            format_workers=format_workers,
+            use_cache=use_cache,
+            resume=False,
+        )
+    except SystemExit:
+        pass
+    elapsed = time.time() - t0
+    server.terminate()
+
+    metrics_file = sorted((workdir / "databases/explainer/metrics").glob("run_*.jsonl"))[-1]
+    summary = [
+        json.loads(line) for line in metrics_file.open()
+        if '"kind": "summary"' in line
+    ][-1]
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    print("")
+    print(f"cards:           {summary['cards_written']}")
+    print(f"elapsed:         {elapsed:.1f}s")
+    print(f"cards/sec:       {summary['cards_written'] / elapsed:.1f}")
+    print(f"peak RSS:        {peak_rss:.0f} MB")
+    for stage in ["queue_wait", "llm_latency", "anki_latency"]:
+        stats = summary[stage]
+        if stats:
+            print(
+                f"{stage + ':':<16} mean {stats['mean'] * 1000:.1f}ms, "
+                f"p50 {stats['p50'] * 1000:.1f}ms, p95 {stats['p95'] * 1000:.1f}ms"
+            )
+    print(f"metrics file:    {metrics_file}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
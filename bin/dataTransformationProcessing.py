@@ -1,6 +1,15 @@
+import collections
+import glob
+import hashlib
 import inspect
+import json
 import math
 import multiprocessing
+import os
+import pickle
+import resource
+import shutil
+import tempfile
 import time
 import traceback
 from time import sleep
@@ -10,66 +19,250 @@ import autosklearn.pipeline.components.classification
 import utility as utl
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
+import numpy as np
 import pandas as pd
 import psutil
 from autosklearn.classification import AutoSklearnClassifier
 from autosklearn.constants import *
 from autosklearn.pipeline.classification import SimpleClassificationPipeline
+from sklearn.model_selection import train_test_split
 
 
-def time_single_estimator(clf_name, clf_class, X, y, max_clf_time, logger):
-    if ('libsvm_svc' == clf_name  # doesn't even scale to a 100k rows
-        or 'qda' == clf_name):  # crashes
-        return 0
-    logger.info(clf_name + " starting")
+_probe_data = None
+
+
+def time_single_estimator(clf_name, clf_class):
+    lo = utl.get_logger(inspect.stack()[0][3])
+
+    # runs in a fresh pool process (maxtasksperchild=1), X and y are inherited
+    # from run_estimators_pool through the fork instead of being pickled. The
+    # forked worker starts with the resident memory of the parent counted in
+    # ru_maxrss, so the peak memory reported is the increase during the fit.
+    X, y = _probe_data
+    lo.info(clf_name + " starting")
     default = clf_class.get_hyperparameter_search_space().get_default_configuration()
     clf = clf_class(**default._values)
+    success = True
+    error = None
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
     t0 = time.time()
     try:
         clf.fit(X, y)
     except Exception as e:
-        logger.info(e)
+        lo.info(e)
+        success = False
+        error = str(e)
     classifier_time = time.time() - t0  # keep time even if classifier crashed
-    logger.info(clf_name + " training time: " + str(classifier_time))
-    if max_clf_time.value < int(classifier_time):
-        max_clf_time.value = int(classifier_time)
-        # no return statement here because max_clf_time is a managed object
+    lo.info(clf_name + " training time: " + str(classifier_time))
+    peak_memory_mb = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024.0
+    return {'classifier': clf_name, 'time': classifier_time, 'success': success,
+            'peak_memory_mb': peak_memory_mb, 'error': error}
+
+
+def dataset_fingerprint(X, y):
+    hasher = hashlib.sha1()
+    hasher.update(str(X.shape).encode())
+    if isinstance(X, pd.DataFrame):
+        hasher.update(str(list(X.columns)).encode())
+        hasher.update(pd.util.hash_pandas_object(X, index=True).values.tobytes())
+    else:
+        hasher.update(str(np.asarray(X).dtype).encode())
+        hasher.update(np.ascontiguousarray(X).tobytes())
+    hasher.update(np.ascontiguousarray(y).tobytes())
+    return hasher.hexdigest()
 
 
-def max_estimators_fit_duration(X, y, max_classifier_time_budget, logger, sample_factor=1):
+def run_estimators_pool(clfs, X, y, deadline, pool_workers):
+    global _probe_data
     lo = utl.get_logger(inspect.stack()[0][3])
 
-    lo.info("Constructing preprocessor pipeline and transforming sample data")
-    # we don't care about the data here but need to preprocess, otherwise the classifiers crash
-
-    pipeline = SimpleClassificationPipeline(
-        include={'imputation': ['most_frequent'], 'rescaling': ['standardize']})
+    # bounded pool with a single deadline, classifiers still running (or not
+    # started) at the deadline are reported as timed out. The workers are
+    # forked with X and y already set, so they share them copy-on-write
+    # instead of each task unpickling its own copy.
+    _probe_data = (X, y)
+    pool = multiprocessing.get_context('fork').Pool(processes=pool_workers, maxtasksperchild=1)
+    try:
+        pending = [(clf_name, pool.apply_async(time_single_estimator, (clf_name, clf_class)))
+                   for clf_name, clf_class in clfs.items()]
+        results = []
+        for clf_name, res in pending:
+            try:
+                results.append(res.get(timeout=max(0, deadline - time.time())))
+            except multiprocessing.TimeoutError:
+                lo.info("Terminating " + clf_name + " due to timeout")
+                results.append({'classifier': clf_name, 'time': None, 'success': False,
+                                'peak_memory_mb': None, 'error': 'timeout'})
+            except Exception as e:
+                # raised outside clf.fit (search space, constructor, result
+                # pickling), only this classifier is lost
+                lo.exception("Error in " + clf_name)
+                results.append({'classifier': clf_name, 'time': None, 'success': False,
+                                'peak_memory_mb': None, 'error': str(e)})
+    finally:
+        pool.terminate()
+        pool.join()
+        _probe_data = None
+    return results
+
+
+def stratified_sample_sizes(n_rows, start=1000, factor=4, max_fraction=0.1):
+    sizes = []
+    size = start
+    while size <= max_fraction * n_rows:
+        sizes.append(int(size))
+        size *= factor
+    return sizes
+
+
+def stratified_sample(X, y, size, seed=0):
+    try:
+        idx, dummy = train_test_split(np.arange(len(y)), train_size=size, stratify=y, random_state=seed)
+    except ValueError:  # a class is too small to be stratified
+        idx = np.random.RandomState(seed).choice(len(y), size, replace=False)
+    idx = np.sort(idx)
+    return X[idx], y[idx]
+
+
+def extrapolate_fit_time(sizes, times, n_rows):
+    # power law time = a * n^b fitted on the log-log points, b is kept >= 1
+    # as no classifier fits in sublinear time on larger data
+    points = [(s, t) for s, t in zip(sizes, times) if t is not None and t > 0]
+    if not points:
+        return None
+    if len(points) == 1:
+        s, t = points[0]
+        return t * n_rows / float(s)
+    log_s = np.log([p[0] for p in points])
+    log_t = np.log([p[1] for p in points])
+    b, log_a = np.polyfit(log_s, log_t, 1)
+    b = max(b, 1.0)
+    return float(np.exp(log_t[-1] + b * (np.log(n_rows) - log_s[-1])))
+
+
+PROBE_CACHE_VERSION = '2'
+PROBE_PREPROCESSING = {'imputation': ['most_frequent'], 'rescaling': ['standardize']}
+
+
+def probe_pipeline():
+    pipeline = SimpleClassificationPipeline(include=PROBE_PREPROCESSING)
     default_cs = pipeline.get_hyperparameter_search_space().get_default_configuration()
-    pipeline = pipeline.set_hyperparameters(default_cs)
+    return pipeline.set_hyperparameters(default_cs), default_cs
+
 
+def preprocess_for_probe(X, y):
+    lo = utl.get_logger(inspect.stack()[0][3])
+
+    lo.info("Constructing preprocessor pipeline and transforming sample data")
+    # we don't care about the data here but need to preprocess, otherwise the classifiers crash
+    pipeline, dummy = probe_pipeline()
     pipeline.fit(X, y)
     X_tr, dummy = pipeline.fit_transformer(X, y)
+    return X_tr
+
+
+def probe_estimators(X, y, max_classifier_time_budget, pool_workers=None, cache_dir=None, subsample=False,
+                     subsample_start=1000, subsample_factor=4, subsample_max_fraction=0.1, X_tr=None,
+                     fingerprint=None):
+    lo = utl.get_logger(inspect.stack()[0][3])
 
-    lo.info("Running estimators on the sample")
     # going over all default classifiers used by auto-sklearn
     clfs = autosklearn.pipeline.components.classification._classifiers
+    skipped = ['libsvm_svc',  # doesn't even scale to a 100k rows
+               'qda']  # crashes
+    clfs = dict((clf_name, clf_class) for clf_name, clf_class in clfs.items() if clf_name not in skipped)
+
+    sizes = []
+    if subsample:
+        sizes = stratified_sample_sizes(len(y), subsample_start, subsample_factor, subsample_max_fraction)
+        if len(sizes) < 2:
+            lo.info("Dataset too small for the subsampling probe, fitting on the full data")
+            sizes = []
+
+    cache_path = None
+    if cache_dir is not None:
+        if fingerprint is None:
+            fingerprint = dataset_fingerprint(X, y)
+        # PROBE_CACHE_VERSION invalidates the tables of a previous estimation
+        key = fingerprint + '_' + str(max_classifier_time_budget) + '_' + \
+            hashlib.sha1((str(sorted(clfs.keys())) + str(sizes) + PROBE_CACHE_VERSION).encode()).hexdigest()[:8]
+        cache_path = os.path.join(cache_dir, 'probe_' + key + '.json')
+        if os.path.exists(cache_path):
+            lo.info("Using cached estimator probe " + cache_path)
+            return pd.read_json(cache_path, orient='records')
+
+    if X_tr is None:
+        X_tr = preprocess_for_probe(X, y)
+
+    if pool_workers is None:
+        pool_workers = int(math.ceil(psutil.cpu_count() / 2.0))
+
+    deadline = time.time() + max_classifier_time_budget
+    if not sizes:
+        lo.info("Running estimators on the sample with " + str(pool_workers) + " worker(s)")
+        results = run_estimators_pool(clfs, X_tr, y, deadline, pool_workers)
+    else:
+        # fit on geometrically increasing stratified samples and extrapolate
+        # the fit time to the full size
+        lo.info("Running estimators on stratified samples of " + str(sizes) + " rows")
+        measured = dict((clf_name, []) for clf_name in clfs)
+        last = {}
+        timed_out = set()
+        remaining = dict(clfs)
+        for size in sizes:
+            if not remaining or time.time() >= deadline:
+                break
+            X_s, y_s = stratified_sample(X_tr, y, size)
+            for r in run_estimators_pool(remaining, X_s, y_s, deadline, pool_workers):
+                measured[r['classifier']].append((size, r['time']))
+                last[r['classifier']] = r
+                if r['time'] is None:  # timed out or crashed, larger samples would too
+                    del remaining[r['classifier']]
+                    if r['error'] == 'timeout':
+                        timed_out.add(r['classifier'])
+        results = []
+        for clf_name in clfs:
+            r = dict(last.get(clf_name, {'classifier': clf_name, 'success': False,
+                                         'peak_memory_mb': None, 'error': 'timeout'}))
+            points = measured[clf_name]
+            r['sample_size'] = points[-1][0] if points else None
+            r['measured_time'] = r.get('time')
+            # extrapolated from the samples it completed, a classifier that
+            # timed out on a sample takes at least the whole budget
+            estimate = extrapolate_fit_time([p[0] for p in points], [p[1] for p in points], len(y))
+            if clf_name in timed_out:
+                estimate = max(estimate or 0, max_classifier_time_budget)
+            r['time'] = estimate
+            results.append(r)
+
+    columns = ['classifier', 'time', 'success', 'peak_memory_mb', 'error']
+    if sizes:
+        columns += ['sample_size', 'measured_time']
+    table = pd.DataFrame(results, columns=columns)
+    for row in table.to_string(index=False).split("\n"):
+        lo.info(row)
+
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        table.to_json(cache_path, orient='records')
+    return table
 
-    processes = []
-    with multiprocessing.Manager() as manager:
-        max_clf_time = manager.Value('i', 3)  # default 3 sec
-        for clf_name, clf_class in clfs.items():
-            pr = multiprocessing.Process(target=time_single_estimator, name=clf_name
-                                         , args=(clf_name, clf_class, X_tr, y, max_clf_time, logger))
-            pr.start()
-            processes.append(pr)
-        for pr in processes:
-            pr.join(max_classifier_time_budget)  # will block for max_classifier_time_budget or
-            # until the classifier fit process finishes. After max_classifier_time_budget 
-            # we will terminate all still running processes here. 
-            if pr.is_alive():
-                logger.info("Terminating " + pr.name + " process due to timeout")
-                pr.terminate()
-        result_max_clf_time = max_clf_time.value
+
+def max_estimators_fit_duration(X, y, max_classifier_time_budget, logger, sample_factor=1, pool_workers=None,
+                                cache_dir=os.path.join(tempfile.gettempdir(), 'atsklrn_probe_cache'),
+                                subsample=False, dataset=None):
+    lo = utl.get_logger(inspect.stack()[0][3])
+
+    # with subsample=True the times are extrapolated from stratified samples,
+    # dataset is the dict returned by load_cached_dataset, its preprocessed
+    # X_tr is then used instead of running the pipeline again
+    kwargs = {}
+    if dataset is not None:
+        kwargs = {'X_tr': dataset['X_tr'], 'fingerprint': dataset['key']}
+    table = probe_estimators(X, y, max_classifier_time_budget, pool_workers=pool_workers, cache_dir=cache_dir,
+                             subsample=subsample, **kwargs)
+    # timed out classifiers are left out, default 3 sec
+    result_max_clf_time = max([3] + [int(t) for t in table['time'].dropna()])
 
     lo.info("Test classifier fit completed")
 
@@ -77,13 +270,125 @@ def max_estimators_fit_duration(X, y, max_classifier_time_budget, logger, sample
     return max_classifier_time_budget if per_run_time_limit > max_classifier_time_budget else per_run_time_limit
 
 
-def read_dataframe_h5(filename, logger):
+def downcast_numeric(df):
+    # smallest float / integer dtype able to hold the values of each column
+    for col in df.select_dtypes(include=['float']).columns:
+        df[col] = pd.to_numeric(df[col], downcast='float')
+    for col in df.select_dtypes(include=['integer']).columns:
+        df[col] = pd.to_numeric(df[col], downcast='integer')
+    return df
+
+
+def read_dataframe_h5(filename, logger, columns=None, start=None, stop=None, downcast=False):
+    # columns and start/stop are applied by the store while reading when the
+    # 'data' node is in table format, only the selection is loaded in memory
     with pd.HDFStore(filename, mode='r') as store:
-        df = store.select('data')
+        df = store.select('data', columns=columns, start=start, stop=stop)
+    if downcast:
+        df = downcast_numeric(df)
     logger.info("Read dataset from the store")
     return df
 
 
+def iter_dataframe_h5(filename, logger, chunksize=100000, columns=None, downcast=False):
+    # requires the 'data' node to be in table format
+    with pd.HDFStore(filename, mode='r') as store:
+        for i, chunk in enumerate(store.select('data', columns=columns, chunksize=chunksize)):
+            if downcast:
+                chunk = downcast_numeric(chunk)
+            logger.info("Read chunk " + str(i) + " of " + str(len(chunk)) + " rows from the store")
+            yield chunk
+
+
+def h5_columns(filename):
+    with pd.HDFStore(filename, mode='r') as store:
+        return list(store.select('data', start=0, stop=0).columns)
+
+
+def h5_string_itemsize(filename, column, default=255):
+    # size of a string column of the 'data' table, so that a table written
+    # chunk by chunk can hold its longest value
+    with pd.HDFStore(filename, mode='r') as store:
+        storer = store.get_storer('data')
+        for axis in getattr(storer, 'values_axes', []):
+            if column in list(axis.values) and axis.kind == 'string':
+                return int(axis.itemsize)
+    return default
+
+
+def read_x_y_matrix_h5(filename, parameter, logger, chunksize=100000, dtype=np.float32):
+    lo = utl.get_logger(inspect.stack()[0][3])
+
+    # same column conventions as x_y_dataframe_split, but X is filled chunk by
+    # chunk into a preallocated C-contiguous matrix so that the full dataframe
+    # is never held in memory
+    x_columns = [c for c in h5_columns(filename)
+                 if c not in (parameter["id_field"], parameter["target_field"])]
+    with pd.HDFStore(filename, mode='r') as store:
+        n_rows = store.get_storer('data').nrows
+    X = np.empty((n_rows, len(x_columns)), dtype=dtype, order='C')
+    y = np.empty(n_rows, dtype='int')
+    row = 0
+    for chunk in iter_dataframe_h5(filename, logger, chunksize=chunksize,
+                                   columns=x_columns + [parameter["target_field"]]):
+        n = len(chunk)
+        X[row:row + n] = chunk[x_columns].to_numpy(dtype=dtype)
+        y[row:row + n] = chunk[parameter["target_field"]].to_numpy(dtype='int')
+        row += n
+    assert row == n_rows, "Unexpected number of rows read from " + filename
+    lo.info("Read X " + str(X.shape) + " as " + str(np.dtype(dtype)) + " and y from the store")
+    return X, y, x_columns
+
+
+def file_hash(filename, block_size=1 << 20):
+    hasher = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def load_cached_dataset(filename, parameter, logger,
+                        cache_dir=os.path.join(tempfile.gettempdir(), 'atsklrn_dataset_cache'), dtype=np.float32):
+    lo = utl.get_logger(inspect.stack()[0][3])
+
+    # X, y and the preprocessed X_tr of the probe are stored as .npy files
+    # keyed by the hash of the input file and the preprocessing config, and
+    # returned as read-only memory maps so that later runs skip the HDF5
+    # read, the split and the pipeline
+    dummy, default_cs = probe_pipeline()
+    config = str(sorted(PROBE_PREPROCESSING.items())) + str(default_cs) + parameter["id_field"] + \
+        parameter["target_field"] + str(np.dtype(dtype))
+    key = file_hash(filename) + '_' + hashlib.sha1(config.encode()).hexdigest()[:12]
+    data_dir = os.path.join(cache_dir, key)
+    names = ['X', 'y', 'X_tr']
+
+    if not os.path.exists(os.path.join(data_dir, 'columns.txt')):
+        lo.info("Building dataset cache " + data_dir)
+        X, y = x_y_dataframe_split(read_dataframe_h5(filename, logger), parameter)
+        arrays = {'X': np.ascontiguousarray(X, dtype=dtype), 'y': y}
+        arrays['X_tr'] = np.ascontiguousarray(preprocess_for_probe(X, y), dtype=dtype)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=key + '_', dir=cache_dir)
+        for name in names:
+            np.save(os.path.join(tmp_dir, name + '.npy'), arrays[name])
+        with open(os.path.join(tmp_dir, 'columns.txt'), 'w') as f:
+            f.write("\n".join(str(c) for c in X.columns))
+        del X, arrays
+        try:
+            os.rename(tmp_dir, data_dir)  # atomic, a concurrent run may have won
+        except OSError:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    else:
+        lo.info("Using dataset cache " + data_dir)
+
+    dataset = dict((name, np.load(os.path.join(data_dir, name + '.npy'), mmap_mode='r')) for name in names)
+    with open(os.path.join(data_dir, 'columns.txt')) as f:
+        dataset['columns'] = f.read().split("\n")
+    dataset['key'] = key
+    return dataset
+
+
 def x_y_dataframe_split(dataframe, parameter, id=False):
     lo = utl.get_logger(inspect.stack()[0][3])
 
@@ -110,9 +415,10 @@ def define_pool_size(memory_limit):
     return half_of_cores if max_pool_size > half_of_cores else max_pool_size
 
 
-def calculate_time_left_for_this_task(pool_size, per_run_time_limit):
+def calculate_time_left_for_this_task(pool_size, per_run_time_limit, queue_factor=30):
+    # queue_factor is the number of per_run_time_limit slots given to each
+    # seed, see telemetry_report for a value measured on a previous run
     half_cpu_cores = pool_size
-    queue_factor = 30
     if queue_factor * half_cpu_cores < 100:  # 100 models to test overall
         queue_factor = 100 / half_cpu_cores
 
@@ -120,8 +426,129 @@ def calculate_time_left_for_this_task(pool_size, per_run_time_limit):
     return time_left_for_this_task
 
 
+def write_telemetry(telemetry_dir, seed, event, **values):
+    # one jsonl file per seed, so the seed processes never share a file
+    record = dict(time=time.time(), seed=seed, event=event, **values)
+    with open(os.path.join(telemetry_dir, 'seed_' + str(seed) + '.jsonl'), 'a') as f:
+        f.write(json.dumps(record, default=str) + '\n')
+
+
+def process_usage():
+    # cpu time and peak memory of this process and of its finished children,
+    # autosklearn fits every model in a child process
+    usage = [resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)]
+    return {'cpu_time': sum(u.ru_utime + u.ru_stime for u in usage),
+            'peak_memory_mb': max(u.ru_maxrss for u in usage) / 1024.0}
+
+
+def configuration_key(params):
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def own_configurations(atsklrn_tempdir, seed):
+    # in shared_mode the run history of a seed also holds the runs of the
+    # other seeds, SMAC only saves the seed's own runs in its runhistory.json
+    path = os.path.join(atsklrn_tempdir, 'smac3-output', 'run_' + str(seed), 'runhistory.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        configs = json.load(f)['configs']
+    return set(configuration_key(params) for params in configs.values())
+
+
+def write_model_telemetry(telemetry_dir, seed, clf, atsklrn_tempdir):
+    # one event per model tried by the seed, from the autosklearn run history
+    cv_results = clf.cv_results_
+    if not cv_results:
+        return 0, 0
+    own = own_configurations(atsklrn_tempdir, seed)
+    n_models = 0
+    n_failed = 0
+    for i, params in enumerate(cv_results['params']):
+        config = configuration_key(params)
+        if own is not None and config not in own:
+            continue
+        n_models += 1
+        status = str(cv_results['status'][i])
+        if status != 'Success':
+            n_failed += 1
+        write_telemetry(telemetry_dir, seed, 'model',
+                        classifier=params.get('classifier:__choice__'),
+                        preprocessor=params.get('preprocessor:__choice__'),
+                        fit_time=float(cv_results['mean_fit_time'][i]),
+                        score=float(cv_results['mean_test_score'][i]),
+                        status=status,
+                        config=config)
+    return n_models, n_failed
+
+
+def read_telemetry(telemetry_dir):
+    records = []
+    for path in sorted(glob.glob(os.path.join(telemetry_dir, 'seed_*.jsonl'))):
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:  # a seed killed while writing
+                    pass
+    return records
+
+
+def telemetry_report(telemetry_dir, per_run_time_limit, target_models=100):
+    # Summarize the events written by the seeds: per seed wall and cpu time,
+    # peak memory, models tried and failures, per classifier fit times. The
+    # queue_factor for calculate_time_left_for_this_task is then derived
+    # from the measured wall time per model, so that the seeds together try
+    # target_models models. Written to summary.json next to the events.
+    lo = utl.get_logger(inspect.stack()[0][3])
+
+    records = read_telemetry(telemetry_dir)
+    if not records:
+        lo.info("No telemetry in " + telemetry_dir)
+        return None
+    events = pd.DataFrame(records)
+    # a model can still be reported by several seeds if their runhistory.json
+    # was missing, it is only counted once
+    models = events[events['event'] == 'model'].drop_duplicates('config')
+    seeds = events[events['event'] == 'seed_end'].set_index('seed')
+
+    summary = {'seeds': len(seeds), 'models': len(models)}
+    if len(models):
+        summary['failed_models'] = int((models['status'] != 'Success').sum())
+        summary['fit_time'] = float(models['fit_time'].sum())
+        by_clf = models.groupby('classifier')['fit_time'].agg(['size', 'mean', 'max'])
+        by_clf.columns = ['models', 'mean_fit_time', 'max_fit_time']
+        by_clf['failed'] = (models['status'] != 'Success').groupby(models['classifier']).sum().astype(int)
+        summary['classifiers'] = by_clf.reset_index().to_dict(orient='records')
+        for row in by_clf.to_string().split("\n"):
+            lo.info(row)
+    if len(seeds):
+        summary['wall_time'] = float(seeds['wall_time'].sum())
+        summary['cpu_time'] = float(seeds['cpu_time'].sum())
+        summary['peak_memory_mb'] = float(seeds['peak_memory_mb'].max())
+        summary['per_seed'] = seeds.reset_index()[
+            ['seed', 'wall_time', 'cpu_time', 'peak_memory_mb', 'models', 'failed_models', 'success']
+        ].to_dict(orient='records')
+        for row in seeds[['wall_time', 'cpu_time', 'peak_memory_mb', 'models', 'failed_models']]\
+                .to_string().split("\n"):
+            lo.info(row)
+        if len(models):
+            # share of the seeds' time spent fitting models, the rest is
+            # autosklearn overhead (metalearning, bookkeeping, waiting)
+            summary['fit_time_share'] = summary['fit_time'] / summary['wall_time']
+            wall_per_model = summary['wall_time'] / len(models)
+            summary['suggested_queue_factor'] = math.ceil(
+                target_models / float(len(seeds)) * wall_per_model / per_run_time_limit)
+            lo.info("Fit time share " + str(round(100 * summary['fit_time_share'], 1)) + "%, suggested queue_factor " +
+                    str(summary['suggested_queue_factor']))
+
+    with open(os.path.join(telemetry_dir, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=2, default=str)
+    return summary
+
+
 def spawn_autosklearn_classifier(X_train, y_train, seed, dataset_name, time_left_for_this_task, per_run_time_limit,
-                                 feat_type, memory_limit, atsklrn_tempdir):
+                                 feat_type, memory_limit, atsklrn_tempdir, telemetry_dir=None):
     lo = utl.get_logger(inspect.stack()[0][3])
 
     try:
@@ -146,6 +573,12 @@ def spawn_autosklearn_classifier(X_train, y_train, seed, dataset_name, time_left
 
     sleep(seed)
 
+    if telemetry_dir is not None:
+        write_telemetry(telemetry_dir, seed, 'seed_start', rows=len(y_train),
+                        time_left_for_this_task=time_left_for_this_task, per_run_time_limit=per_run_time_limit,
+                        memory_limit=memory_limit)
+    t0 = time.time()
+    error = None
     try:
         lo.info("Starting seed=" + str(seed))
         try:
@@ -154,47 +587,139 @@ def spawn_autosklearn_classifier(X_train, y_train, seed, dataset_name, time_left
             lo = utl.get_logger(inspect.stack()[0][3])
             lo.exception("Error in clf.fit - seed:" + str(seed))
             raise
-    except Exception:
+    except Exception as e:
+        error = repr(e)
         lo = utl.get_logger(inspect.stack()[0][3])
         lo.exception("Exception in seed=" + str(seed) + ".  ")
         traceback.print_exc()
         raise
+    finally:
+        if telemetry_dir is not None:
+            # never let the telemetry hide the outcome of the fit
+            n_models = n_failed = None
+            try:
+                n_models, n_failed = write_model_telemetry(telemetry_dir, seed, clf, atsklrn_tempdir)
+            except Exception:
+                lo.exception("Error writing the model telemetry - seed:" + str(seed))
+            try:
+                write_telemetry(telemetry_dir, seed, 'seed_end', wall_time=time.time() - t0, models=n_models,
+                                failed_models=n_failed, success=error is None, error=error, **process_usage())
+            except Exception:
+                lo.exception("Error writing the seed telemetry - seed:" + str(seed))
     lo = utl.get_logger(inspect.stack()[0][3])
     lo.info("####### Finished seed=" + str(seed))
     return None
 
 
-def train_multicore(X, y, feat_type, memory_limit, atsklrn_tempdir, pool_size=1, per_run_time_limit=60):
+def share_training_data(X, y, data_dir, dtype=None):
     lo = utl.get_logger(inspect.stack()[0][3])
 
-    time_left_for_this_task = calculate_time_left_for_this_task(pool_size, per_run_time_limit)
+    # written once as contiguous .npy files, every worker then maps the same
+    # pages instead of receiving its own pickled copy of the dataframe. X
+    # keeps its dtype unless dtype is given (e.g. np.float32 to halve the size)
+    X_path = os.path.join(data_dir, 'X_train.npy')
+    y_path = os.path.join(data_dir, 'y_train.npy')
+    np.save(X_path, np.ascontiguousarray(X, dtype=dtype))
+    np.save(y_path, np.ascontiguousarray(y))
+    lo.info("Training data shared in " + data_dir + " (" + str(os.path.getsize(X_path) // 1000000) + " MB)")
+    return X_path, y_path
 
-    lo.info("Max time allowance for a model " + str(math.ceil(per_run_time_limit / 60.0)) + " minute(s)")
-    lo.info("Overal run time is about " + str(2 * math.ceil(time_left_for_this_task / 60.0)) + " minute(s)")
 
-    processes = []
-    for i in range(2, pool_size + 2):  # reserve seed 1 for the ensemble building
-        seed = i
-        pr = multiprocessing.Process(target=spawn_autosklearn_classifier
-                                     , args=(
-            X, y, i, 'foobar', time_left_for_this_task, per_run_time_limit, feat_type, memory_limit, atsklrn_tempdir))
-        pr.start()
-        lo.info("Multicore process " + str(seed) + " started")
-        processes.append(pr)
-    for pr in processes:
-        pr.join()
+def load_shared_training_data(X_path, y_path):
+    # read-only memory map, zero-copy view on the shared file
+    return np.load(X_path, mmap_mode='r'), np.load(y_path, mmap_mode='r')
 
-    lo.info("Multicore fit completed")
 
+def spawn_autosklearn_classifier_shared(X_path, y_path, seed, dataset_name, time_left_for_this_task,
+                                        per_run_time_limit, feat_type, memory_limit, atsklrn_tempdir,
+                                        telemetry_dir=None):
+    X_train, y_train = load_shared_training_data(X_path, y_path)
+    return spawn_autosklearn_classifier(X_train, y_train, seed, dataset_name, time_left_for_this_task,
+                                        per_run_time_limit, feat_type, memory_limit, atsklrn_tempdir,
+                                        telemetry_dir)
 
-def zeroconf_fit_ensemble(y, atsklrn_tempdir):
-    lo = utl.get_logger(inspect.stack()[0][3])
-
-    lo.info("Building ensemble")
 
-    seed = 1
+def process_tree_rss(pid):
+    # autosklearn runs every model fit in a child process, count them too
+    try:
+        proc = psutil.Process(pid)
+        procs = [proc] + proc.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return 0
+    rss = 0
+    for p in procs:
+        try:
+            rss += p.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return rss
+
+
+def schedule_seed_processes(target, seed_args, memory_limit, max_workers=None, memory_headroom=1.5,
+                            max_load_per_core=1.0, poll_interval=5, report_interval=60):
+    # Launch one process per seed, only while the node has room for it: a new
+    # seed is started when fewer than max_workers seeds are running, the
+    # available memory is above memory_headroom * memory_limit (MB) and the
+    # 1 minute load average per core is below max_load_per_core. Launches are
+    # paused otherwise and the RSS of every running seed is reported every
+    # report_interval seconds. A seed is always launched when none is running,
+    # so a node busy with other jobs slows the run down but never stalls it.
+    lo = utl.get_logger(inspect.stack()[0][3])
 
-    ensemble = AutoSklearnClassifier(
+    if max_workers is None:
+        max_workers = psutil.cpu_count()
+    pending = list(seed_args)
+    running = {}
+    paused = False
+    last_report = 0
+    while pending or running:
+        for seed, pr in list(running.items()):
+            if not pr.is_alive():
+                pr.join()
+                lo.info("Multicore process " + str(seed) + " finished with exit code " + str(pr.exitcode))
+                del running[seed]
+
+        if pending and len(running) < max_workers:
+            available = psutil.virtual_memory().available
+            load = os.getloadavg()[0] / psutil.cpu_count()
+            has_room = available >= memory_headroom * memory_limit * 1000000 and load < max_load_per_core
+            if has_room or not running:
+                if not has_room:
+                    lo.info("No seed running, launching one despite available memory " +
+                            str(available // 1000000) + " MB, load per core " + str(round(load, 2)))
+                elif paused:
+                    lo.info("Resuming launches")
+                paused = False
+                seed, args = pending.pop(0)
+                pr = multiprocessing.Process(target=target, args=args)
+                pr.start()
+                lo.info("Multicore process " + str(seed) + " started")
+                running[seed] = pr
+                # let the new process allocate before measuring again
+                sleep(poll_interval)
+                continue
+            if not paused:
+                lo.info("Pausing launches: available memory " + str(available // 1000000) + " MB, load per core "
+                        + str(round(load, 2)) + ", " + str(len(pending)) + " seed(s) waiting")
+                paused = True
+
+        if time.time() - last_report >= report_interval and running:
+            last_report = time.time()
+            for seed, pr in running.items():
+                lo.info("Seed " + str(seed) + " RSS " + str(process_tree_rss(pr.pid) // 1000000) + " MB")
+
+        sleep(poll_interval)
+
+
+def ensemble_prediction_files(atsklrn_tempdir):
+    # every model evaluated by a seed leaves its out-of-fold predictions here,
+    # they are what fit_ensemble builds the ensemble from
+    return glob.glob(os.path.join(atsklrn_tempdir, '.auto-sklearn', 'predictions_ensemble',
+                                  'predictions_ensemble_*.npy'))
+
+
+def ensemble_classifier(atsklrn_tempdir, seed=1):
+    return AutoSklearnClassifier(
         time_left_for_this_task=300, per_run_time_limit=150, ml_memory_limit=20240, ensemble_size=50,
         ensemble_nbest=200,
         shared_mode=True, tmp_folder=atsklrn_tempdir, output_folder=atsklrn_tempdir,
@@ -202,28 +727,157 @@ def zeroconf_fit_ensemble(y, atsklrn_tempdir):
         initial_configurations_via_metalearning=0,
         seed=seed)
 
-    lo.info("Done AutoSklearnClassifier - seed:" + str(seed))
 
+def fit_ensemble(ensemble, y):
+    ensemble.fit_ensemble(
+        task=BINARY_CLASSIFICATION
+        , y=y
+        , metric=autosklearn.metrics.f1
+        , precision='32'
+        , dataset_name='foobar'
+        , ensemble_size=10
+        , ensemble_nbest=15)
+
+
+def save_ensemble(ensemble, ensemble_path, n_predictions):
+    # written next to the final path then renamed, a reader never sees a
+    # partial pickle
+    tmp_path = ensemble_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump({'ensemble': ensemble, 'n_predictions': n_predictions}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, ensemble_path)
+
+
+def load_ensemble(ensemble_path):
+    with open(ensemble_path, 'rb') as f:
+        return pickle.load(f)
+
+
+def incremental_ensemble_builder(y_path, atsklrn_tempdir, ensemble_path, stop_event, poll_interval=30,
+                                 min_new_predictions=5):
+    # Runs next to the seed processes: every poll_interval seconds, refit the
+    # ensemble when at least min_new_predictions models landed since the
+    # last fit, and persist it to ensemble_path so a usable model exists
+    # before the seeds are done. Once stop_event is set (all the seeds
+    # joined), a last fit picks up the remaining models.
+    lo = utl.get_logger(inspect.stack()[0][3])
+
+    y = np.load(y_path, mmap_mode='r')
+    ensemble = ensemble_classifier(atsklrn_tempdir)
+    n_built = 0
+    while True:
+        stopping = stop_event.wait(poll_interval)
+        n_predictions = len(ensemble_prediction_files(atsklrn_tempdir))
+        if n_predictions > n_built and (stopping or n_predictions - n_built >= min_new_predictions):
+            t0 = time.time()
+            try:
+                fit_ensemble(ensemble, np.asarray(y))
+            except Exception:
+                # the seeds may be writing the predictions, try again later
+                lo.exception("Error in incremental fit_ensemble with " + str(n_predictions) + " models")
+            else:
+                save_ensemble(ensemble, ensemble_path, n_predictions)
+                n_built = n_predictions
+                lo.info("Ensemble updated with " + str(n_predictions) + " models in " +
+                        str(round(time.time() - t0, 1)) + "s")
+        if stopping:
+            return
+
+
+def train_multicore(X, y, feat_type, memory_limit, atsklrn_tempdir, pool_size=1, per_run_time_limit=60,
+                    adaptive=False, max_workers=None, ensemble_path=None, ensemble_poll_interval=30,
+                    telemetry_dir=None, queue_factor=30, dtype=None):
+    lo = utl.get_logger(inspect.stack()[0][3])
+
+    time_left_for_this_task = calculate_time_left_for_this_task(pool_size, per_run_time_limit, queue_factor)
+    if telemetry_dir is not None:
+        os.makedirs(telemetry_dir, exist_ok=True)
+
+    lo.info("Max time allowance for a model " + str(math.ceil(per_run_time_limit / 60.0)) + " minute(s)")
+    lo.info("Overal run time is about " + str(2 * math.ceil(time_left_for_this_task / 60.0)) + " minute(s)")
+
+    data_dir = tempfile.mkdtemp(prefix='atsklrn_data_')
+    builder = None
     try:
-        lo.debug("Start ensemble.fit_ensemble - seed:" + str(seed))
-        ensemble.fit_ensemble(
-            task=BINARY_CLASSIFICATION
-            , y=y
-            , metric=autosklearn.metrics.f1
-            , precision='32'
-            , dataset_name='foobar'
-            , ensemble_size=10
-            , ensemble_nbest=15)
-    except Exception:
-        lo = utl.get_logger(inspect.stack()[0][3])
-        lo.exception("Error in ensemble.fit_ensemble - seed:" + str(seed))
-        raise
+        X_path, y_path = share_training_data(X, y, data_dir, dtype)
+
+        if ensemble_path is not None:
+            # build the ensemble while the seeds run instead of after them
+            stop_event = multiprocessing.Event()
+            builder = multiprocessing.Process(target=incremental_ensemble_builder,
+                                              args=(y_path, atsklrn_tempdir, ensemble_path, stop_event,
+                                                    ensemble_poll_interval))
+            builder.start()
+            lo.info("Incremental ensemble builder started")
+
+        seed_args = [
+            (i, (X_path, y_path, i, 'foobar', time_left_for_this_task, per_run_time_limit, feat_type, memory_limit,
+                 atsklrn_tempdir, telemetry_dir))
+            for i in range(2, pool_size + 2)]  # reserve seed 1 for the ensemble building
+
+        if adaptive:
+            # pool_size is then the number of seeds, how many run at once
+            # depends on the live memory and load of the node
+            schedule_seed_processes(spawn_autosklearn_classifier_shared, seed_args, memory_limit,
+                                    max_workers=max_workers)
+        else:
+            processes = []
+            for seed, args in seed_args:
+                pr = multiprocessing.Process(target=spawn_autosklearn_classifier_shared, args=args)
+                pr.start()
+                lo.info("Multicore process " + str(seed) + " started")
+                processes.append(pr)
+            for pr in processes:
+                pr.join()
+    finally:
+        if builder is not None:
+            stop_event.set()
+            builder.join()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    lo.info("Multicore fit completed")
+
+    if telemetry_dir is not None:
+        telemetry_report(telemetry_dir, per_run_time_limit)
+
 
+def zeroconf_fit_ensemble(y, atsklrn_tempdir, ensemble_path=None):
     lo = utl.get_logger(inspect.stack()[0][3])
-    lo.debug("Done ensemble.fit_ensemble - seed:" + str(seed))
 
-    sleep(20)
-    lo.info("Ensemble built - seed:" + str(seed))
+    seed = 1
+
+    ensemble = None
+    if ensemble_path is not None and os.path.exists(ensemble_path):
+        # built by train_multicore while the seeds ran, only refit if models
+        # landed after its last update
+        saved = load_ensemble(ensemble_path)
+        if saved['n_predictions'] == len(ensemble_prediction_files(atsklrn_tempdir)):
+            lo.info("Using the ensemble built incrementally with " + str(saved['n_predictions']) + " models")
+            ensemble = saved['ensemble']
+
+    if ensemble is None:
+        lo.info("Building ensemble")
+
+        ensemble = ensemble_classifier(atsklrn_tempdir, seed)
+
+        lo.info("Done AutoSklearnClassifier - seed:" + str(seed))
+
+        try:
+            lo.debug("Start ensemble.fit_ensemble - seed:" + str(seed))
+            n_predictions = len(ensemble_prediction_files(atsklrn_tempdir))
+            fit_ensemble(ensemble, y)
+        except Exception:
+            lo = utl.get_logger(inspect.stack()[0][3])
+            lo.exception("Error in ensemble.fit_ensemble - seed:" + str(seed))
+            raise
+
+        lo = utl.get_logger(inspect.stack()[0][3])
+        lo.debug("Done ensemble.fit_ensemble - seed:" + str(seed))
+
+        if ensemble_path is not None:
+            save_ensemble(ensemble, ensemble_path, n_predictions)
+
+        lo.info("Ensemble built - seed:" + str(seed))
 
     lo.info("Show models - seed:" + str(seed))
     txtList = str(ensemble.show_models()).split("\n")
@@ -231,3 +885,77 @@ def zeroconf_fit_ensemble(y, atsklrn_tempdir):
         lo.info(row)
 
     return ensemble
+
+
+_scoring_ensemble = None
+
+
+def init_scoring_worker(ensemble_path):
+    # with the fork start method the workers inherit the ensemble loaded by
+    # batch_predict, it is only loaded again under spawn
+    global _scoring_ensemble
+    if _scoring_ensemble is None:
+        _scoring_ensemble = load_ensemble(ensemble_path)['ensemble']
+
+
+def score_chunk(row_id, X):
+    return row_id, _scoring_ensemble.predict_proba(X)
+
+
+def batch_predict(ensemble_path, filename, output_path, parameter, logger, chunksize=100000, n_workers=None,
+                  dtype=np.float32):
+    # Score the rows of an HDF5 file with the ensemble saved by
+    # train_multicore/zeroconf_fit_ensemble. Rows are read chunk by chunk
+    # with the x_y_dataframe_split column conventions (the target column is
+    # not needed), scored in n_workers processes, and the predictions are
+    # appended in input order to the 'data' table of output_path with the
+    # id_field, so neither the input nor the predictions are held in memory.
+    # At most 2 chunks per worker are in flight.
+    global _scoring_ensemble
+    lo = utl.get_logger(inspect.stack()[0][3])
+
+    if n_workers is None:
+        n_workers = psutil.cpu_count()
+    _scoring_ensemble = load_ensemble(ensemble_path)['ensemble']
+    lo.info("Loaded ensemble " + ensemble_path)
+
+    id_field = parameter["id_field"]
+    x_columns = [c for c in h5_columns(filename) if c not in (id_field, parameter["target_field"])]
+    # the table fixes the size of string columns on the first append, string
+    # ids are sized from the input table instead of the first chunk
+    min_itemsize = {id_field: h5_string_itemsize(filename, id_field)}
+    if os.path.exists(output_path):
+        os.remove(output_path)
+
+    t0 = time.time()
+    n_rows = 0
+    pending = collections.deque()
+    pool = multiprocessing.Pool(n_workers, initializer=init_scoring_worker, initargs=(ensemble_path,))
+    try:
+        with pd.HDFStore(output_path, mode='w') as out:
+            def write(result):
+                row_id, proba = result.get()
+                out.append('data', pd.DataFrame({id_field: row_id,
+                                                 'prediction': np.argmax(proba, axis=1),
+                                                 'probability': proba[:, 1]}),
+                           format='table', index=False,
+                           min_itemsize=min_itemsize if row_id.dtype == object else None)
+                return len(row_id)
+
+            for chunk in iter_dataframe_h5(filename, logger, chunksize=chunksize, columns=[id_field] + x_columns):
+                if len(pending) >= 2 * n_workers:
+                    n_rows += write(pending.popleft())
+                pending.append(pool.apply_async(score_chunk, (chunk[id_field].to_numpy(),
+                                                              chunk[x_columns].to_numpy(dtype=dtype))))
+            while pending:
+                n_rows += write(pending.popleft())
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        _scoring_ensemble = None
+
+    elapsed = time.time() - t0
+    lo.info("Scored " + str(n_rows) + " rows in " + str(round(elapsed, 1)) + "s (" +
+            str(int(n_rows / max(elapsed, 1e-6))) + " rows/s) into " + output_path)
+    return n_rows
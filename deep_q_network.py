@@ -8,7 +8,6 @@ sys.path.append("game/")
 import wrapped_flappy_bird as game
 import random
 import numpy as np
-from collections import deque
 
 GAME = 'bird' # the name of the game being played for log files
 ACTIONS = 2 # number of valid actions
@@ -20,6 +19,58 @@ INITIAL_EPSILON = 0.0001 # starting value of epsilon
 REPLAY_MEMORY = 50000 # number of previous transitions to remember
 BATCH = 32 # size of minibatch
 FRAME_PER_ACTION = 1
+HISTORY = 4 # number of stacked frames in a state
+TARGET_UPDATE = 0 # timesteps between syncs of the target network, 0 to bootstrap from the online network
+DOUBLE_DQN = False # online network picks the next action, target network evaluates it (needs TARGET_UPDATE)
+
+class ReplayMemory(object):
+    # Ring buffer of the last `capacity` transitions. Each 80x80 frame is
+    # stored once and the 80x80x4 states are rebuilt from consecutive frames:
+    # frame k is the newest frame of the state after transition k - HISTORY,
+    # as states are stacked across episodes the frames of a state are always
+    # the HISTORY previous ones.
+    def __init__(self, capacity, frame_shape=(80, 80), history=HISTORY):
+        self.capacity = capacity
+        self.history = history
+        self.n_frames = capacity + history
+        self.frames = np.zeros((self.n_frames,) + tuple(frame_shape), dtype=np.uint8)
+        self.actions = np.zeros(capacity, dtype=np.int32)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.terminals = np.zeros(capacity, dtype=np.bool_)
+        self.frame_count = 0
+        self.count = 0 # transitions stored so far, including overwritten ones
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def reset(self, x_t):
+        # the first state is the first frame repeated
+        for _ in range(self.history):
+            self._push_frame(x_t)
+
+    def _push_frame(self, x_t):
+        self.frames[self.frame_count % self.n_frames] = x_t
+        self.frame_count += 1
+
+    def append(self, a_t, r_t, x_t1, terminal):
+        i = self.count % self.capacity
+        self.actions[i] = np.argmax(a_t)
+        self.rewards[i] = r_t
+        self.terminals[i] = terminal
+        self._push_frame(x_t1)
+        self.count += 1
+
+    def _states(self, first_frames):
+        # newest frame first, like the states built in trainNetwork
+        offsets = np.arange(self.history - 1, -1, -1)
+        idx = (first_frames[:, None] + offsets[None, :]) % self.n_frames
+        return self.frames[idx].transpose(0, 2, 3, 1)
+
+    def sample(self, batch_size):
+        j = np.random.randint(self.count - len(self), self.count, size=batch_size)
+        i = j % self.capacity
+        a_batch = np.eye(ACTIONS, dtype=np.float32)[self.actions[i]]
+        return self._states(j), a_batch, self.rewards[i], self._states(j + 1), self.terminals[i]
 
 def weight_variable(shape):
     initial = tf.truncated_normal(shape, stddev = 0.01)
@@ -75,19 +126,47 @@ def createNetwork():
 
     return s, readout, h_fc1
 
-def trainNetwork(s, readout, h_fc1, sess):
-    # define the cost function
+def createTargetNetwork():
+    # frozen copy of the network created last, only updated by running sync
+    online_vars = tf.trainable_variables()
+    with tf.variable_scope("target"):
+        s, readout, h_fc1 = createNetwork()
+    target_vars = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope="target")
+    sync = tf.group(*[t.assign(o) for o, t in zip(online_vars, target_vars)])
+    return s, readout, sync
+
+def trainNetwork(s, readout, h_fc1, sess, target=None):
+    # define the cost function, the targets r + (1 - terminal) * GAMMA * max Q
+    # are computed in the graph. When the online network's Q values of the
+    # next states are needed, s is fed with s_j and s_j1 stacked.
     a = tf.placeholder("float", [None, ACTIONS])
-    y = tf.placeholder("float", [None])
-    readout_action = tf.reduce_sum(tf.multiply(readout, a), reduction_indices=1)
+    r = tf.placeholder("float", [None])
+    terminal_mask = tf.placeholder("float", [None])
+    stacked = target is None or DOUBLE_DQN
+    if stacked:
+        readout_j, readout_j1 = tf.split(readout, 2)
+    else:
+        readout_j = readout
+    if target is None:
+        q_j1 = tf.reduce_max(readout_j1, reduction_indices=1)
+    else:
+        s_target, readout_target, sync_target = target
+        if DOUBLE_DQN:
+            action_j1 = tf.one_hot(tf.argmax(readout_j1, 1), ACTIONS)
+            q_j1 = tf.reduce_sum(tf.multiply(readout_target, action_j1), reduction_indices=1)
+        else:
+            q_j1 = tf.reduce_max(readout_target, reduction_indices=1)
+    y = r + (1. - terminal_mask) * GAMMA * tf.stop_gradient(q_j1)
+    readout_action = tf.reduce_sum(tf.multiply(readout_j, a), reduction_indices=1)
     cost = tf.reduce_mean(tf.square(y - readout_action))
-    train_step = tf.train.AdamOptimizer(1e-6).minimize(cost)
+    online_vars = [v for v in tf.trainable_variables() if not v.name.startswith("target/")]
+    train_step = tf.train.AdamOptimizer(1e-6).minimize(cost, var_list=online_vars)
 
     # open up a game state to communicate with emulator
     game_state = game.GameState()
 
     # store the previous observations in replay memory
-    D = deque()
+    D = ReplayMemory(REPLAY_MEMORY)
 
     # printing
     a_file = open("logs_" + GAME + "/readout.txt", 'w')
@@ -100,9 +179,11 @@ def trainNetwork(s, readout, h_fc1, sess):
     x_t = cv2.cvtColor(cv2.resize(x_t, (80, 80)), cv2.COLOR_BGR2GRAY)
     ret, x_t = cv2.threshold(x_t,1,255,cv2.THRESH_BINARY)
     s_t = np.stack((x_t, x_t, x_t, x_t), axis=2)
+    D.reset(x_t)
 
     # saving and loading networks
-    saver = tf.train.Saver()
+    # the target network is not saved, it is synced from the restored weights
+    saver = tf.train.Saver([v for v in tf.global_variables() if not v.name.startswith("target/")])
     sess.run(tf.initialize_all_variables())
     checkpoint = tf.train.get_checkpoint_state("saved_networks")
     if checkpoint and checkpoint.model_checkpoint_path:
@@ -110,6 +191,8 @@ def trainNetwork(s, readout, h_fc1, sess):
         print("Successfully loaded:", checkpoint.model_checkpoint_path)
     else:
         print("Could not find old network weights")
+    if target is not None:
+        sess.run(sync_target)
 
     # start training
     epsilon = INITIAL_EPSILON
@@ -143,37 +226,25 @@ def trainNetwork(s, readout, h_fc1, sess):
         s_t1 = np.append(x_t1, s_t[:, :, :3], axis=2)
 
         # store the transition in D
-        D.append((s_t, a_t, r_t, s_t1, terminal))
-        if len(D) > REPLAY_MEMORY:
-            D.popleft()
+        D.append(a_t, r_t, x_t1[:, :, 0], terminal)
 
         # only train if done observing
         if t > OBSERVE:
             # sample a minibatch to train on
-            minibatch = random.sample(D, BATCH)
-
-            # get the batch variables
-            s_j_batch = [d[0] for d in minibatch]
-            a_batch = [d[1] for d in minibatch]
-            r_batch = [d[2] for d in minibatch]
-            s_j1_batch = [d[3] for d in minibatch]
-
-            y_batch = []
-            readout_j1_batch = readout.eval(feed_dict = {s : s_j1_batch})
-            for i in range(0, len(minibatch)):
-                terminal = minibatch[i][4]
-                # if terminal, only equals reward
-                if terminal:
-                    y_batch.append(r_batch[i])
-                else:
-                    y_batch.append(r_batch[i] + GAMMA * np.max(readout_j1_batch[i]))
-
-            # perform gradient step
-            train_step.run(feed_dict = {
-                y : y_batch,
+            s_j_batch, a_batch, r_batch, s_j1_batch, terminal_batch = D.sample(BATCH)
+
+            # perform gradient step, the targets are computed in the same run
+            feed_dict = {
+                r : r_batch,
+                terminal_mask : terminal_batch.astype(np.float32),
                 a : a_batch,
-                s : s_j_batch}
-            )
+                s : np.concatenate((s_j_batch, s_j1_batch)) if stacked else s_j_batch}
+            if target is not None:
+                feed_dict[s_target] = s_j1_batch
+            train_step.run(feed_dict = feed_dict)
+
+            if target is not None and t % TARGET_UPDATE == 0:
+                sess.run(sync_target)
 
         # update the old values
         s_t = s_t1
@@ -206,7 +277,8 @@ def trainNetwork(s, readout, h_fc1, sess):
 def playGame():
     sess = tf.InteractiveSession()
     s, readout, h_fc1 = createNetwork()
-    trainNetwork(s, readout, h_fc1, sess)
+    target = createTargetNetwork() if TARGET_UPDATE else None
+    trainNetwork(s, readout, h_fc1, sess, target)
 
 def main():
     playGame()
@@ -5,30 +5,42 @@ This module provides functionality to automatically generate explanations for fa
 Anki cards using large language models, helping users better understand concepts
 they're struggling with.
 """
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
 from inspect import signature
-from bs4 import BeautifulSoup
+import threading
 from tqdm import tqdm
 from tqdm_logger import TqdmLogger
 import datetime
 import re
 import time
-import json
 from pathlib import Path
 from typing import List
 import fire
-import copy
 
-from utils.misc import send_ntfy, load_formatting_funcs, replace_media
-from utils.anki import anki, sync_anki, addtags, removetags, updatenote
+from utils.misc import send_ntfy, load_formatting_funcs
+from utils.anki import anki, sync_anki, addtags, removetags
 from utils.logger import create_loggers
 from utils.llm import load_api_keys, llm_price, llm_cost_compute, tkn_len, chat, model_name_matcher
-from utils.datasets import load_dataset, semantic_prompt_filtering
+from utils.datasets import load_dataset
+from utils.history import HistoryStore
+from utils.cache import ResponseCache
+from utils.embeddings import ExampleIndex
+from utils.anki_batch import AnkiWriteBuffer
+from utils.metrics import RunMetrics
+from utils.journal import RunJournal
+from utils.ratelimit import get_limiter, call_with_retry
+from utils.worker import BackgroundWorker
+from utils.card_formatting import format_card, format_card_worker, init_worker
 
 Path("databases").mkdir(exist_ok=True)
 EXPLAINER_DIR = Path("databases/explainer")
 EXPLAINER_DIR.mkdir(exist_ok=True)
 
+# legacy history file, migrated to the jsonl file on first load
 EXPLAINER_HIST_PATH = EXPLAINER_DIR / "explainer_history.json"
+EXPLAINER_HIST_LOG_PATH = EXPLAINER_DIR / "explainer_history.jsonl"
+EXPLAINER_CACHE_PATH = EXPLAINER_DIR / "explainer_cache.sqlite"
+EXPLAINER_JOURNAL_PATH = EXPLAINER_DIR / "explainer_run_journal.jsonl"
 
 log_file = EXPLAINER_DIR / "explainer_logs.txt"
 Path(log_file).touch()
@@ -37,6 +49,25 @@ whi, yel, red = create_loggers(log_file, ["white", "yellow", "red"])
 # load api key
 load_api_keys()
 
+def cached_tokens(usage):
+    """
+    Number of input tokens read from the provider prompt cache, as reported
+    by openai ('prompt_tokens_details.cached_tokens') or anthropic
+    ('cache_read_input_tokens'), 0 if not reported.
+    """
+    def get(obj, key):
+        if obj is None:
+            return None
+        if isinstance(obj, dict):
+            return obj.get(key)
+        return getattr(obj, key, None)
+
+    cached = get(get(usage, "prompt_tokens_details"), "cached_tokens")
+    if not cached:
+        cached = get(usage, "cache_read_input_tokens")
+    return int(cached or 0)
+
+
 class AnkiExplainer:
     VERSION = "1.7"
 
@@ -57,6 +88,21 @@ class AnkiExplainer:
         debug: bool = False,
         force: bool = False,
         ntfy_url: str = None,
+        max_concurrency: int = 1,
+        use_cache: bool = True,
+        cache_max_entries: int = 10000,
+        cache_max_age_days: float = 90,
+        embedding_batch_size: int = 256,
+        anki_batch_size: int = 50,
+        format_workers: int = 1,
+        page_size: int = None,
+        max_budget: float = None,
+        max_runtime: float = None,
+        resume: bool = True,
+        rpm: float = None,
+        tpm: float = None,
+        max_retries: int = 5,
+        stable_prefix: bool = False,
     ):
         """
         Parameters
@@ -109,15 +155,101 @@ class AnkiExplainer:
             if True, will not ignore note that already contain an
             illustration of the same version.
             Used for debugging, resetting or if you're rich.
+
+        max_concurrency: int, default 1
+            number of LLM requests allowed in flight at the same time.
+            Cards are still edited, saved to history and notified in the
+            same order as with a single request at a time.
+
+        use_cache: bool, default True
+            if True, LLM responses are cached on disk by hash of the
+            messages, model and temperature so that identical prompts
+            (including with --force) are not paid for twice.
+
+        cache_max_entries: int, default 10000
+            maximum number of responses kept in the cache
+
+        cache_max_age_days: float, default 90
+            cached responses older than that are evicted
+
+        embedding_batch_size: int, default 256
+            number of cards embedded per request when embedding all the
+            cards up front
+
+        anki_batch_size: int, default 50
+            number of notes whose edits are grouped in a single
+            AnkiConnect 'multi' request. The buffer is also flushed at the
+            end of each deck.
+
+        format_workers: int, default 1
+            number of processes used to format the content of the cards,
+            only used when there are at least 100 cards to format.
+
+        page_size: int, default None
+            if set, the cardsInfo are fetched, formatted and explained by
+            pages of that many cards instead of all at once. Memory use
+            then doesn't depend on the number of cards, so the 1000 cards
+            cap is not applied. Notifications are sent per deck for each
+            page.
+
+        max_budget: float, default None
+            if set, no new LLM call is made once the run spent that many
+            dollars. The remaining cards are left untouched.
+
+        max_runtime: float, default None
+            if set, no new LLM call is made after that many seconds.
+
+        resume: bool, default True
+            if True and the previous run with the same query, model and
+            fields was interrupted, resume it from its journal: the cards
+            that were already formatted are not fetched again, and the
+            LLM responses that were received but not written to Anki are
+            not requested again.
+
+        rpm: float, default None
+            requests per minute allowed by the provider for this model
+
+        tpm: float, default None
+            tokens per minute allowed by the provider for this model,
+            estimated with tkn_len for the input plus the average
+            completion length.
+            All the LLM calls go through a token bucket respecting rpm and
+            tpm that slows down further when rate limit errors happen.
+
+        max_retries: int, default 5
+            number of retries of a failed LLM call, with jittered
+            exponential backoff
+
+        stable_prefix: bool, default False
+            if True, the examples are not selected by similarity but taken
+            in the order of the dataset, so that all prompts share the same
+            prefix. For anthropic models the end of that prefix is marked
+            with cache_control so that the provider caches it. The number
+            of cached input tokens is saved in the history.
+
+        Timing (queue wait, LLM and AnkiConnect latency), token and cost
+        metrics of each run are written to
+        databases/explainer/metrics/run_<timestamp>.jsonl
         """
         # logger for tqdm progress bars
         self.t_strm = TqdmLogger(log_file)
         self.t_strm.reset()
         self.dataset = load_dataset(dataset_path)
         self.ntfy_url = ntfy_url
+        # notifications and periodic syncs don't block the explaining loop
+        self.side_effects = BackgroundWorker(on_error=self._report_error)
 
         self.llm_model = model
         self.embedding_model = embedding_model
+        # embed the few-shot examples once per run (or load them from disk)
+        self.example_index = ExampleIndex(
+            dataset=self.dataset,
+            embedding_model=embedding_model,
+            cache_dir=EXPLAINER_DIR,
+            batch_size=embedding_batch_size,
+            whi=whi,
+            red=red,
+        )
         if self.llm_model in llm_price:
             self.llm_price = llm_price[self.llm_model]
         elif self.llm_model.split("/", 1)[1] in llm_price:
@@ -125,6 +257,37 @@ class AnkiExplainer:
         elif model_name_matcher(self.llm_model) in llm_price:
             self.price = llm_price[model_name_matcher(self.llm_model)]
         self.llm_max_token = llm_max_token
+        assert max_concurrency >= 1, "max_concurrency must be at least 1"
+        self.max_concurrency = int(max_concurrency)
+        self.limiter = get_limiter(self.llm_model, rpm=rpm, tpm=tpm)
+        self.max_retries = max_retries
+        self.stable_prefix = stable_prefix
+
+        if use_cache:
+            self.cache = ResponseCache(
+                EXPLAINER_CACHE_PATH,
+                max_entries=cache_max_entries,
+                max_age_days=cache_max_age_days,
+            )
+        else:
+            self.cache = None
+        self._cache_locks = {}
+        self._cache_locks_lock = threading.Lock()
+
+        self.metrics = RunMetrics(
+            EXPLAINER_DIR / "metrics",
+            max_budget=max_budget,
+            max_runtime=max_runtime,
+        )
+        self.budget_warned = False
+
+        self.anki_buffer = AnkiWriteBuffer(
+            flush_every=anki_batch_size,
+            red=red,
+            on_flush=self._on_anki_flush,
+        )
+        # note id to the card ids whose edits are still in the buffer
+        self.unflushed = {}
 
         # only if explainer has not been updated
         if not force:
@@ -147,15 +310,39 @@ class AnkiExplainer:
         # load history of already explainer cards
         self._load_history()
 
-        # find cid of recently failed cards
-        red(f"Loading failed cards with query '{query}'")
-        failed = anki(action="findCards", query=query)
         self.note_mode = note_mode
         if note_mode:
             whi(f"note_mode enabled, don't count cards of the same note twice.")
 
-        if not failed:
-            raise SystemExit("No card corresponding to query found")
+        # resume an interrupted run if there is one
+        journal_params = {
+            "query": query,
+            "model": self.llm_model,
+            "field_names": self.field_names,
+            "note_mode": note_mode,
+            "version": self.VERSION,
+        }
+        self.journal = RunJournal(EXPLAINER_JOURNAL_PATH, red=red)
+        resumed = self.journal.load(journal_params) if resume else None
+        self.resumed = resumed is not None
+        self.responses = {}
+        if resumed:
+            red(
+                "Resuming interrupted run: "
+                f"'{len(resumed['pending'])}' cards pending of which "
+                f"'{len(resumed['responses'])}' were already explained"
+            )
+            failed = [c for c in resumed["failed"] if c not in resumed["fetched"]]
+            self.responses = resumed["responses"]
+        else:
+            # find cid of recently failed cards
+            red(f"Loading failed cards with query '{query}'")
+            failed = anki(action="findCards", query=query)
+
+            if not failed:
+                raise SystemExit("No card corresponding to query found")
+
+            self.journal.start(journal_params, failed)
 
         yel(f"Found '{len(failed)}' cards failed recently")
 
@@ -171,123 +358,282 @@ class AnkiExplainer:
                 assert "cloze" in params, f"{func} must have 'cloze' as argument"
             self.cloze_input_parser = cloze_input_parser
         self.string_formatting = string_formatting
+        self.format_workers = int(format_workers)
+        self.n_processed = 0
+        self.nids_so_far = set()
 
-        # gather info about those failed cards
-        failed_info = anki(action="cardsInfo", cards=failed)
-        assert len(failed_info) == len(failed), "Invalid cards info length"
-        self.failed_info = failed_info
+        d = datetime.datetime.today()
+        if d.hour <= 5:
+            # get yesterday's date if it's too early in the day
+            d = datetime.datetime.today() - datetime.timedelta(1)
+        self.today = f"{d.day:02d}/{d.month:02d}/{d.year:04d}"
 
-        # filter cards based on history
-        self._filter_failed()
+        try:
+            pbar = tqdm(unit="cards", file=self.t_strm)
+            card = None
+            if resumed:
+                self.nids_so_far.update(resumed["notes"])
+                if resumed["pending"]:
+                    # the pending cards were already fetched and formatted
+                    self.failed_info = resumed["pending"]
+                    self._set_deck_list()
+                    self._embed_failed()
+                    card = self._explain_failed(pbar)
+
+            if not failed:
+                pass
+            elif page_size is None:
+                # gather info about those failed cards
+                failed_info = anki(action="cardsInfo", cards=failed)
+                assert len(failed_info) == len(failed), "Invalid cards info length"
+                self.failed_info = failed_info
+
+                # filter cards based on history
+                self._filter_failed(allow_empty=card is not None)
+                self.journal.fetched(failed)
+
+                # abort if more than X cards
+                if len(self.failed_info) > 1000:
+                    red(
+                        "too many cards, skipping some just in case: "
+                        f"'{len(self.failed_info)}'"
+                    )
+                    self.failed_info = self.failed_info[:1000]
+                #            raise Exception(
+                #                    "too many cards, aborting just in case: "
+                #                    f"'{len(self.failed_info)}'")
+
+                if self.failed_info:
+                    # embed the content of all cards in batches
+                    self._embed_failed()
+
+                    # create explainer and send notifications, by deck
+                    pbar.total = pbar.n + len(self.failed_info) + len(self.deck_list)
+                    pbar.refresh()
+                    card = self._explain_failed(pbar)
+            else:
+                # stream the cards page by page, only one page of cardsInfo
+                # is held in memory at a time so there is no cap on the number
+                # of cards
+                for page_info in self._iter_pages(failed, page_size):
+                    self.failed_info = page_info
+                    self._embed_failed()
+                    card = self._explain_failed(pbar)
+                self.failed_info = []
+                self.query_embeddings = {}
+            if card is None:
+                self.journal.finish()
+                raise SystemExit("No cards to notify of after filtering.")
+            pbar.close()
+
+            # add and remove the tag TODO to make it easier to readd by the user
+            # as it was cleared by calling 'clearUnusedTags'
+            addtags(card["note"], tags="AnkiExplainer::TODO")
+            removetags(card["note"], tags="AnkiExplainer::TODO")
+        finally:
+            # wait for the pending notifications and syncs, also when the
+            # run fails between two pages
+            self.side_effects.drain()
 
-        # abort if more than X cards
-        if len(self.failed_info) > 1000:
-            red(
-                "too many cards, skipping some just in case: "
-                f"'{len(self.failed_info)}'"
-            )
-            self.failed_info = self.failed_info[:1000]
-        #            raise Exception(
-        #                    "too many cards, aborting just in case: "
-        #                    f"'{len(self.failed_info)}'")
-
-        # create explainer and send notifications, by deck
-        pbar = tqdm(
-            total=len(self.failed_info) + len(self.deck_list),
-            unit="cards",
-            file=self.t_strm,
+        # sync at the end
+        if do_sync:
+            sync_anki()
+        self.journal.finish()
+
+        if self.cache is not None:
+            yel(f"Response {self.cache.stats()}")
+            self.cache.close()
+
+        summary = self.metrics.summary()
+        yel(
+            f"Run metrics: {summary['cards_written']} cards in "
+            f"{summary['elapsed']:.0f}s, ${summary['dollar_cost']:.4f} "
+            f"(${summary['dollar_per_card']:.4f}/card), "
+            f"{summary['tokens_per_second']:.1f} tokens/s, "
+            f"{summary['skipped']} skipped, see '{self.metrics.path}'"
         )
-        cnt = 0
+
+        if debug:
+            red("Finished. Openning console.")
+            breakpoint()
+        else:
+            red("Finished.")
+            raise SystemExit()
+
+    def _iter_pages(self, failed, page_size):
+        """
+        Fetch the cardsInfo of the failed cards by chunks of page_size and
+        yield the filtered and formatted cards of each chunk.
+
+        Parameters
+        ----------
+        failed : list of int
+            card ids returned by findCards
+        page_size : int
+            number of cards fetched per cardsInfo request
+        """
+        for start in range(0, len(failed), page_size):
+            page = failed[start:start + page_size]
+            whi(f"Fetching cards {start}-{start + len(page)} of {len(failed)}")
+            failed_info = anki(action="cardsInfo", cards=page)
+            assert len(failed_info) == len(page), "Invalid cards info length"
+            self.failed_info = failed_info
+            self._filter_failed(allow_empty=True)
+            self.journal.fetched(page)
+            if self.failed_info:
+                yield self.failed_info
+
+    def _explain_failed(self, pbar):
+        """
+        Explain the cards of self.failed_info, grouped by deck.
+
+        Parameters
+        ----------
+        pbar : tqdm
+            Progress bar to update
+
+        Returns
+        -------
+        dict
+            The last card that was processed
+        """
+        deck_cards = {}
         for deck in self.deck_list:
             cards = [c for c in self.failed_info if c["deckName"] == deck]
-            cards = sorted(cards, key=lambda x: x["formatted_content"])
+            deck_cards[deck] = sorted(cards, key=lambda x: x["formatted_content"])
+
+        # the LLM calls are dispatched to a thread pool ahead of time while
+        # the responses are consumed in order here, so that editing the
+        # notes, saving the history and notifying stay sequential
+        self.journal.queued(
+            [card for deck in self.deck_list for card in deck_cards[deck]]
+        )
+        executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        futures = {}
+        for deck in self.deck_list:
+            for card in deck_cards[deck]:
+                cid = str(card["cardId"])
+                if cid in self.responses:
+                    # received before the previous run was interrupted
+                    futures[cid] = Future()
+                    futures[cid].set_result(self.responses.pop(cid))
+                    continue
+                futures[cid] = executor.submit(
+                    self._explain,
+                    card_content=card["formatted_content"],
+                    query_embedding=self.query_embeddings.get(cid),
+                    submitted_at=time.time(),
+                    cid=cid,
+                )
+
+        try:
+            card = self._process_decks(deck_cards, futures, pbar)
+        except BaseException:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        executor.shutdown(wait=True)
+        return card
+
+    def _process_decks(self, deck_cards, futures, pbar):
+        """
+        Consume the explanations deck by deck, in the same order as they
+        were dispatched, then edit the notes, save the history and send
+        the notifications.
+
+        Parameters
+        ----------
+        deck_cards : dict
+            Mapping of deck name to the sorted list of cards of that deck
+        futures : dict
+            Mapping of card id (as str) to the future of its '_explain' call
+        pbar : tqdm
+            Progress bar to update
+
+        Returns
+        -------
+        dict
+            The last card that was processed
+        """
+        for deck in self.deck_list:
             to_send = []
-            for card in cards:
-                cnt += 1
+            for card in deck_cards[deck]:
+                self.n_processed += 1
                 cid = str(card["cardId"])
                 content = card["formatted_content"]
 
-                response = self._explain(
-                    card_content=content,
-                )
+                response = futures[cid].result()
+                if response is None:
+                    # skipped because the budget was exceeded
+                    pbar.update(1)
+                    continue
                 input_cost = response["usage"]["prompt_tokens"]
+                cached_input = cached_tokens(response["usage"])
                 output_cost = response["usage"]["completion_tokens"]
                 explan = response["choices"][0]["message"]["content"]
+                cache_hit = isinstance(response, dict) and response.get("cache_hit", False)
 
                 explan = re.sub(r"\* ([A-Z]+\b)", r"* <b>\1</b>", explan)
 
                 to_send.append(explan)
 
                 self._edit_anki_card(card=card, explanation=explan)
-
-                if cid in self.history:
-                    self.history[cid]
-                    self.history[cid].append(
-                        {
-                            "cardsInfo": card,
-                            "timestamp": int(time.time()),
-                            "datetime": self.today,
-                            "explan": explan,
-                            "obsolete": False,
-                            "input_cost": input_cost,
-                            "output_cost": output_cost,
-                            "dollar_cost": llm_cost_compute(
-                                input_cost, output_cost, self.llm_price
-                            ),
-                            "input_string": content,
-                        }
-                    )
-                else:
-                    self.history[cid] = [
-                        {
-                            "cardsInfo": card,
-                            "timestamp": int(time.time()),
-                            "datetime": self.today,
-                            "explan": explan,
-                            "obsolete": False,
-                            "input_cost": input_cost,
-                            "output_cost": output_cost,
-                            "dollar_cost": llm_cost_compute(
-                                input_cost, output_cost, self.llm_price
-                            ),
-                            "input_string": content,
-                        }
-                    ]
-                self._save_history()
+                self.unflushed.setdefault(int(card["note"]), []).append(cid)
+
+                if self.resumed and cid in self.history and any(
+                    h["explan"] == explan for h in self.history[cid]
+                ):
+                    # already saved before the previous run was interrupted
+                    pbar.update(1)
+                    continue
+
+                self.history.append(
+                    cid,
+                    {
+                        "cardsInfo": card,
+                        "timestamp": int(time.time()),
+                        "datetime": self.today,
+                        "explan": explan,
+                        "obsolete": False,
+                        "input_cost": input_cost,
+                        "output_cost": output_cost,
+                        "cached_input_tokens": cached_input,
+                        "dollar_cost": 0 if cache_hit else llm_cost_compute(
+                            input_cost, output_cost, self.llm_price
+                        ),
+                        "cache_hit": cache_hit,
+                        "input_string": content,
+                    },
+                )
+                self.metrics.record("card_written", cid=cid)
 
                 pbar.update(1)
 
                 # sync regularly
-                if cnt % 100 == 0:
-                    sync_anki()
+                if self.n_processed % 100 == 0:
+                    self.anki_buffer.flush()
+                    self.side_effects.submit("sync", sync_anki)
 
+            self.anki_buffer.flush()
             pbar.update(1)
             tqdm.write(f"Done with deck '{deck}\n\n'")
 
-            self._send_notif(contents=to_send, deckname=deck)
-
-        pbar.close()
-
-        # add and remove the tag TODO to make it easier to readd by the user
-        # as it was cleared by calling 'clearUnusedTags'
-        addtags(card["note"], tags="AnkiExplainer::TODO")
-        removetags(card["note"], tags="AnkiExplainer::TODO")
+            self.side_effects.submit(
+                f"notification of '{deck}'",
+                self._send_notif,
+                contents=to_send,
+                deckname=deck,
+            )
 
-        # sync at the end
-        if do_sync:
-            sync_anki()
-
-        if debug:
-            red("Finished. Openning console.")
-            breakpoint()
-        else:
-            red("Finished.")
-            raise SystemExit()
+        return card
 
     def _edit_anki_card(self, card, explanation):
         """
         Update an Anki card with a new explanation.
 
+        The edits are queued in self.anki_buffer and sent in batches, a
+        note whose edits failed is tagged 'AnkiExplainer::failed' when the
+        buffer is flushed.
+
         Parameters
         ----------
         card : dict
@@ -321,21 +667,48 @@ class AnkiExplainer:
 
         new = new.replace("\r", "<br>").replace("\n", "<br>")  # html newlines
 
-        try:
-            updatenote(nid, fields={"AnkiExplainer": new})
-
-            # add tag to note if success
-            addtags(nid, tags=f"AnkiExplainer::done::{self.today}")
-
-            # remove failed tags
-            removetags(nid, tags="AnkiExplainer::failed AnkiExplainer::todo")
-
-        except Exception as err:
-            red(f"Exception when editing '{nid}': '{err}'")
-            # add tag to note if faileed
-            addtags(nid, tags="AnkiExplainer::failed")
+        done_tag = f"AnkiExplainer::done::{self.today}"
+        self.anki_buffer.add(
+            nid,
+            [
+                {
+                    "action": "updateNoteFields",
+                    "params": {"note": {"id": nid, "fields": {"AnkiExplainer": new}}},
+                },
+                # add tag to note if success
+                {"action": "addTags", "params": {"notes": [nid], "tags": done_tag}},
+                # remove failed tags
+                {
+                    "action": "removeTags",
+                    "params": {
+                        "notes": [nid],
+                        "tags": "AnkiExplainer::failed AnkiExplainer::todo",
+                    },
+                },
+            ],
+            success_tag=done_tag,
+        )
 
-    def _explain(self, card_content):
+    def _embed_failed(self):
+        """
+        Embed the formatted content of all the cards to explain in batches
+        of embedding_batch_size, instead of one request per card.
+        """
+        # cards explained before an interrupted run don't need embeddings
+        cards = [f for f in self.failed_info if str(f["cardId"]) not in self.responses]
+        self.query_embeddings = {}
+        if not cards or self.stable_prefix:
+            return
+        contents = [f["formatted_content"] for f in cards]
+        whi(f"Embedding the content of {len(contents)} cards")
+        t0 = time.time()
+        matrix = self.example_index.embed(contents)
+        self.metrics.record("embed", n_cards=len(contents), latency=time.time() - t0)
+        self.query_embeddings = {
+            str(f["cardId"]): matrix[i] for i, f in enumerate(cards)
+        }
+
+    def _explain(self, card_content, query_embedding=None, submitted_at=None, cid=None):
         """
         Generate an explanation for a card's content using an LLM.
 
@@ -343,121 +716,205 @@ class AnkiExplainer:
         ----------
         card_content : str
             The content of the card to explain
+        query_embedding : np.ndarray, default None
+            Precomputed embedding of card_content, used to select the
+            examples
+        submitted_at : float, default None
+            time at which the call was submitted to the thread pool, used
+            to measure the queue wait
+        cid : str, default None
+            id of the card, used to save the response in the run journal
 
         Returns
         -------
-        tuple
-            (input_token_cost, output_token_cost, image_prompt, reasoning, discarded_text)
+        dict or None
+            the LLM response, or None if the budget of the run was
+            exceeded before the call
         """
-        messages = semantic_prompt_filtering(
-            curr_mess={"role": "user", "content": card_content},
-            max_token=self.llm_max_token,
-            temperature=0,
-            prompt_messages=copy.deepcopy(self.dataset),
-            keywords="",
-            embedding_model=self.embedding_model,
-            whi=whi,
-            yel=yel,
-            red=red,
-        ) + [
+        queue_wait = time.time() - submitted_at if submitted_at else 0
+        reason = self.metrics.budget_exceeded()
+        if reason:
+            if not self.budget_warned:
+                self.budget_warned = True
+                red(f"Budget exceeded ({reason}), not explaining new cards")
+            self.metrics.record("skipped", queue_wait=queue_wait)
+            return None
+
+        if self.stable_prefix:
+            examples = self.example_index.select_prefix(
+                query=card_content,
+                max_token=self.llm_max_token,
+            )
+        else:
+            examples = self.example_index.select(
+                query=card_content,
+                max_token=self.llm_max_token,
+                query_embedding=query_embedding,
+            )
+        messages = examples + [
                 {
                     "role": "user",
                     "content": card_content
                     }
                 ]
 
-        assert tkn_len(messages) <= self.llm_max_token
-        response = chat(
-            messages=messages,
-            model=self.llm_model,
-            temperature=0.0,
-            frequency_penalty=0,
-            presence_penalty=0,
-            num_retries=5,
+        # counted on the plain messages, before the content of the last
+        # example is turned into blocks for anthropic
+        n_tokens = tkn_len(messages)
+        assert n_tokens <= self.llm_max_token
+        if self.stable_prefix and any(
+            n in self.llm_model for n in ["anthropic", "claude"]
+        ):
+            # mark the end of the shared prefix for anthropic prompt caching
+            last = messages[-2]
+            messages[-2] = {
+                **last,
+                "content": [
+                    {
+                        "type": "text",
+                        "text": last["content"],
+                        "cache_control": {"type": "ephemeral"},
+                    }
+                ],
+            }
+        t0 = time.time()
+        response = self._cached_chat(messages, n_tokens)
+        llm_latency = time.time() - t0
+
+        cache_hit = isinstance(response, dict) and response.get("cache_hit", False)
+        input_tokens = response["usage"]["prompt_tokens"]
+        output_tokens = response["usage"]["completion_tokens"]
+        self.metrics.record(
+            "llm_call",
+            queue_wait=queue_wait,
+            cached_input_tokens=cached_tokens(response["usage"]),
+            llm_latency=llm_latency,
+            input_tokens=input_tokens,
+            output_tokens=output_tokens,
+            tokens_per_second=output_tokens / llm_latency if llm_latency else 0,
+            dollar_cost=0 if cache_hit else llm_cost_compute(
+                input_tokens, output_tokens, self.llm_price
+            ),
+            cache_hit=cache_hit,
         )
+        if cid is not None:
+            self.journal.explained(cid, response)
         return response
 
-    def _filter_failed(self):
+    def _cached_chat(self, messages, n_tokens):
+        """
+        send the messages to the LLM unless the response is in the cache,
+        n_tokens is the number of input tokens of the messages
+        """
+        if self.cache is None:
+            return self._chat(messages, n_tokens)
+
+        key = ResponseCache.make_key(messages, self.llm_model, 0.0)
+        # identical prompts sent concurrently wait for the first response
+        with self._cache_locks_lock:
+            key_lock = self._cache_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            cached = self.cache.get(key)
+            if cached is not None:
+                whi("Using cached LLM response")
+                cached["cache_hit"] = True
+                return cached
+            response = self._chat(messages, n_tokens)
+            self.cache.put(key, self.llm_model, response)
+        return response
+
+    def _chat(self, messages, n_tokens):
+        "send the messages (of n_tokens input tokens) to the LLM, through the rate limiter"
+        response, waited = call_with_retry(
+            lambda: chat(
+                messages=messages,
+                model=self.llm_model,
+                temperature=0.0,
+                frequency_penalty=0,
+                presence_penalty=0,
+                num_retries=0,
+            ),
+            limiter=self.limiter,
+            input_tokens=n_tokens,
+            max_retries=self.max_retries,
+            red=red,
+        )
+        if waited:
+            self.metrics.record("rate_limit_wait", latency=waited)
+        return response
+
+    def _filter_failed(self, allow_empty=False):
         """
         removes from the list of failed cards the one that were already
         notified in the recent days
 
         also removes the cloze indicator of another card but the same note
         (= remove c1 if the failed cards was c2).
+
+        The notes seen so far are kept in self.nids_so_far so that the
+        duplicates are also found across pages when streaming.
+
+        Parameters
+        ----------
+        allow_empty : bool, default False
+            if False, exit when no card is left after filtering
         """
-        to_filter = []
+        to_filter = set()
         self.explanations = []
-        nids_so_far = []
-
-        d = datetime.datetime.today()
-        if d.hour <= 5:
-            # get yesterday's date if it's too early in the day
-            d = datetime.datetime.today() - datetime.timedelta(1)
-        self.today = f"{d.day:02d}/{d.month:02d}/{d.year:04d}"
+        nids_so_far = self.nids_so_far
 
-        for i, f in enumerate(tqdm(self.failed_info, file=self.t_strm)):
+        to_format = []
+        for f in self.failed_info:
             cid = str(f["cardId"])
 
             # don't count cards of the same note type twice
             if self.note_mode:
                 nid = f["note"]
                 if nid in nids_so_far:
-                    to_filter.append(cid)
+                    to_filter.add(cid)
+                    continue
                 else:
-                    nids_so_far.append(nid)
+                    nids_so_far.add(nid)
 
             # filter if the card is not a 'relearning' or 'review' card
             # (i.e. exclude new cards)
             # reference: 0=new, 1=learning, 2=review, 3=relearning
             # if int(f["type"]) not in [2, 3]:
-            #     to_filter.append(cid)
+            #     to_filter.add(cid)
             #     continue
 
-            fields = f["fields"]
-            content = ""
-            for fn in self.field_names:
-                content += f"\n{fn.title()}: {fields[fn]['value'].strip()}"
-            content = content.strip()
-            orig_content = content
-
-            content, _ = replace_media(
-                content=content,
-                media=None,
-                mode="remove_media")
-
-            # light formatting
-            if self.string_formatting:
-                content = self.cloze_input_parser(content)
-
-            if not self.note_mode:
-                cord = int(f["ord"]) + 1
-                remaining_digits = "".join(
-                    [str(x) for x in range(0, 10) if int(x) != cord]
-                )
-                content = re.sub(
-                    "{{" + f"c[{remaining_digits}]::(.*?)" + "}}",
-                    r"\1",
-                    content,
-                    flags=re.DOTALL | re.M,
-                )
-            else:
-                content = re.sub(
-                    "{{c[0-9]+::(.*?)}}", r"\1", content, flags=re.DOTALL | re.M
-                )
-
-            content = content.replace("<br>", "\n").replace("<br/>", "\n")
-            content = content.replace("\r", "\n")
-            content = content.replace(" }}\n", "}}\n")
+            to_format.append(f)
 
-            soup = BeautifulSoup(content, "html.parser")
-            content = soup.get_text()
+        args = [
+            (f["fields"], f["ord"], self.field_names, self.note_mode)
+            for f in to_format
+        ]
+        if self.format_workers > 1 and len(args) >= 100:
+            with ProcessPoolExecutor(
+                max_workers=self.format_workers,
+                initializer=init_worker,
+                initargs=(self.string_formatting,),
+            ) as pool:
+                formatted = pool.map(
+                    format_card_worker,
+                    args,
+                    chunksize=max(1, len(args) // (self.format_workers * 4)),
+                )
+                formatted = list(tqdm(formatted, total=len(args), file=self.t_strm))
+        else:
+            parser = self.cloze_input_parser if self.string_formatting else None
+            formatted = [
+                format_card(*a, cloze_input_parser=parser)
+                for a in tqdm(args, file=self.t_strm)
+            ]
 
+        for f, (orig_content, content) in zip(to_format, formatted):
             whi(f"Old content: '{orig_content}'")
             whi(f"New content: '{content}'")
             print("")
 
             # store content for history
-            self.failed_info[i]["formatted_content"] = content
+            f["formatted_content"] = content
 
         yel(f"Cards filtered: '{len(to_filter)}'")
         self.failed_info = [
@@ -465,14 +922,33 @@ class AnkiExplainer:
         ]
         yel(f"Cards to explain: '{len(self.failed_info)}'")
 
-        if not self.failed_info:
+        if not self.failed_info and not allow_empty:
             raise SystemExit("No cards to notify of after filtering.")
 
-        # get list of unique decks
+        self._set_deck_list()
+
+    def _set_deck_list(self):
+        "get list of unique decks"
         self.deck_list = list(set([f["deckName"] for f in self.failed_info]))
         self.deck_list = sorted(self.deck_list, reverse=True)
         red(f"Unique decks: '{self.deck_list}'")
 
+    def _on_anki_flush(self, nids, **kwargs):
+        "record the flush of the AnkiConnect buffer in the metrics and journal"
+        self.metrics.record("anki_flush", **kwargs)
+        cids = [cid for nid in nids for cid in self.unflushed.pop(nid, [])]
+        self.journal.written(cids)
+
+    def _report_error(self, name, tb):
+        "report the failure of a background task to the log and to ntfy"
+        red(f"Error in background task {name}: '{tb}'")
+        if self.ntfy_url:
+            send_ntfy(
+                url=self.ntfy_url,
+                title=f"AnkiExplainer - 'error in {name}'",
+                content=tb,
+            )
+
     def _send_notif(self, contents, deckname):
         """
         send notification to phone
@@ -509,54 +985,37 @@ class AnkiExplainer:
                     "cost" the token cost of the explanation
                 these subdicts are only added when a card was explained
                     and sent
+
+        The history is stored as an append-only jsonl file (see
+        utils/history.py), the legacy json file is migrated on first load.
+        Only the spending is computed here, by streaming the file, the
+        mapping itself is loaded lazily.
         """
         whi("Loading history")
-        hist_file = Path(EXPLAINER_HIST_PATH)
-        if hist_file.exists():
-            try:
-                self.history = json.load(hist_file.open())
-            except Exception as err:
-                red(f"Failed to load history json file: '{err}'")
-                self.history = {}
-        else:
+        self.history = HistoryStore(EXPLAINER_HIST_LOG_PATH, red=red)
+        try:
+            if self.history.migrate(EXPLAINER_HIST_PATH):
+                red(f"Migrated history from '{EXPLAINER_HIST_PATH}'")
+        except Exception as err:
+            red(f"Failed to migrate history json file: '{err}'")
+        if not EXPLAINER_HIST_LOG_PATH.exists():
             red("History file not found")
-            self.history = {}
-        assert isinstance(self.history, dict)
+
         total_dol = 0
-        for cid, hist in self.history.items():
-            for i, h in enumerate(hist):
-                if "dollar_cost" in h:
-                    total_dol += h["dollar_cost"]
-                elif "dollar_cost_retroactive" in h:
-                    total_dol += h["dollar_cost_retroactive"]
-                else:
-                    raise ValueError(
-                        "Missing dollar_cost (or retroactive) column in history"
-                    )
+        for cid, h in self.history.iter_entries():
+            if "dollar_cost" in h:
+                total_dol += h["dollar_cost"]
+            elif "dollar_cost_retroactive" in h:
+                total_dol += h["dollar_cost_retroactive"]
+            else:
+                raise ValueError(
+                    "Missing dollar_cost (or retroactive) column in history"
+                )
 
         red(f"Total spending so far: ${total_dol:.2f}")
 
         return
 
-    def _save_history(self):
-        """
-        Save the explanation history to a JSON file.
-        
-        Creates a temporary file first then renames it to avoid corruption
-        if the process is interrupted.
-        """
-        hist_p = str(EXPLAINER_HIST_PATH.absolute())
-        while hist_p.endswith("/"):
-            hist_p = hist_p[:-1]
-        hist_pt = hist_p + "_temp"
-        with open(str(Path(hist_pt).absolute()), "w") as f:
-            json.dump(self.history, f, indent=2)
-        assert Path(hist_pt).exists(), "New temporary history file not found"
-        Path(hist_p).unlink(missing_ok=True)
-        Path(hist_pt).rename(hist_p)
-        assert Path(hist_p).exists(), "New history file not found after renaming temp file"
-        assert Path(hist_p).absolute() == EXPLAINER_HIST_PATH.absolute()
-
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,121 @@
+"""
+Buffered writes to AnkiConnect.
+
+Note edits are accumulated and sent as a single AnkiConnect 'multi' request
+instead of one round-trip per action.
+"""
+import time
+
+from utils.anki import anki
+
+
+class AnkiWriteBuffer:
+    """
+    Accumulate the AnkiConnect actions of several notes and send them
+    together with the 'multi' action.
+
+    The results of the 'multi' request are mapped back to the note that
+    queued them, so that the notes whose actions failed can be tagged with
+    failed_tag and have success_tag removed.
+    """
+
+    def __init__(self, flush_every=50, failed_tag="AnkiExplainer::failed", red=print, on_flush=None):
+        """
+        Parameters
+        ----------
+        flush_every : int, default 50
+            number of notes after which the buffer is flushed
+        failed_tag : str
+            tag added to the notes whose actions failed
+        red : callable
+            logger
+        on_flush : callable, default None
+            called after each flush with the keyword arguments nids (the
+            flushed note ids), n_notes, n_actions, n_failed and latency
+            (in seconds)
+        """
+        self.on_flush = on_flush
+        self.flush_every = flush_every
+        self.failed_tag = failed_tag
+        self.red = red
+        self.pending = []
+
+    def add(self, nid, actions, success_tag=None):
+        """
+        Queue the actions of a note and flush if the buffer is full.
+
+        Parameters
+        ----------
+        nid : int
+            note id
+        actions : list of dict
+            AnkiConnect actions, as dicts with keys 'action' and 'params'
+        success_tag : str, default None
+            tag to remove from the note if one of its actions failed
+        """
+        self.pending.append((int(nid), actions, success_tag))
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """
+        Send all queued actions in one 'multi' request and tag the notes
+        whose actions failed.
+
+        Returns
+        -------
+        list of int
+            ids of the notes for which at least one action failed
+        """
+        if not self.pending:
+            return []
+        pending, self.pending = self.pending, []
+
+        flat = []
+        for nid, actions, _ in pending:
+            flat.extend(actions)
+
+        failed = []
+        t0 = time.time()
+        try:
+            results = anki(action="multi", actions=flat)
+            assert len(results) == len(flat), "Invalid multi result length"
+            i = 0
+            for nid, actions, success_tag in pending:
+                errors = [
+                    r["error"] for r in results[i:i + len(actions)]
+                    if isinstance(r, dict) and r.get("error")
+                ]
+                i += len(actions)
+                if errors:
+                    self.red(f"Exception when editing '{nid}': '{errors}'")
+                    failed.append((nid, success_tag))
+        except Exception as err:
+            self.red(f"Exception when sending {len(flat)} actions: '{err}'")
+            failed = [(nid, success_tag) for nid, _, success_tag in pending]
+
+        if failed:
+            fallback = [
+                {
+                    "action": "addTags",
+                    "params": {"notes": [nid for nid, _ in failed], "tags": self.failed_tag},
+                }
+            ]
+            fallback += [
+                {"action": "removeTags", "params": {"notes": [nid], "tags": tag}}
+                for nid, tag in failed if tag
+            ]
+            try:
+                anki(action="multi", actions=fallback)
+            except Exception as err:
+                self.red(f"Exception when tagging failed notes: '{err}'")
+
+        if self.on_flush is not None:
+            self.on_flush(
+                nids=[nid for nid, _, _ in pending],
+                n_notes=len(pending),
+                n_actions=len(flat),
+                n_failed=len(failed),
+                latency=time.time() - t0,
+            )
+        return [nid for nid, _ in failed]
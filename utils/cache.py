@@ -0,0 +1,135 @@
+"""
+Persistent, content-addressed cache of LLM responses.
+
+The key is the hash of the messages, the model and the temperature so that
+identical prompts are only paid for once, even across runs.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+
+def response_to_dict(response):
+    """
+    Convert a chat response to a json serializable dict, responses can be
+    dicts or objects with a 'model_dump' or 'json' method like litellm
+    responses.
+    """
+    if hasattr(response, "model_dump"):
+        return response.model_dump()
+    elif hasattr(response, "json") and not isinstance(response, dict):
+        return json.loads(response.json())
+    return response
+
+
+class ResponseCache:
+    """
+    SQLite backed cache of chat responses with size and age eviction.
+
+    Entries older than max_age_days are dropped when the cache is opened,
+    and the least recently used entries are dropped when there are more
+    than max_entries.
+    """
+
+    def __init__(self, path, max_entries=10000, max_age_days=90):
+        """
+        Parameters
+        ----------
+        path : str or Path
+            path to the sqlite file
+        max_entries : int, default 10000
+            maximum number of responses kept
+        max_age_days : float, default 90
+            responses older than this are evicted
+        """
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, "
+            "model TEXT, "
+            "response TEXT, "
+            "created REAL, "
+            "accessed REAL)"
+        )
+        self._conn.commit()
+        self._evict()
+
+    @staticmethod
+    def make_key(messages, model, temperature):
+        "hash of everything that determines the response"
+        payload = json.dumps(
+            {"messages": messages, "model": model, "temperature": temperature},
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key):
+        """
+        Return the cached response as a dict, or None if missing.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute(
+                "UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key)
+            )
+            self._conn.commit()
+        return json.loads(row[0])
+
+    def put(self, key, model, response):
+        """
+        Store a response, see response_to_dict for the accepted types.
+        """
+        response = response_to_dict(response)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, model, json.dumps(response, ensure_ascii=False), now, now),
+            )
+            self._conn.commit()
+            self._evict_oldest()
+
+    def _evict(self):
+        with self._lock:
+            if self.max_age_days:
+                limit = time.time() - self.max_age_days * 24 * 3600
+                self._conn.execute("DELETE FROM responses WHERE created < ?", (limit,))
+                self._conn.commit()
+            self._evict_oldest()
+
+    def _evict_oldest(self):
+        if not self.max_entries:
+            return
+        self._conn.execute(
+            "DELETE FROM responses WHERE key IN ("
+            "SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+        self._conn.commit()
+
+    def stats(self):
+        "string summary of the hit and miss counters"
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0
+        return f"cache hits: {self.hits}, misses: {self.misses} ({rate:.1f}% hit rate)"
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
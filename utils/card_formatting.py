@@ -0,0 +1,112 @@
+"""
+Formatting of the content of Anki cards before sending it to the LLM.
+
+The functions are defined at module level so that they can be used by a
+process pool when formatting thousands of cards.
+"""
+import html
+import re
+from functools import lru_cache
+
+from bs4 import BeautifulSoup
+
+from utils.misc import load_formatting_funcs, replace_media
+
+ALL_CLOZES = re.compile("{{c[0-9]+::(.*?)}}", flags=re.DOTALL | re.M)
+SIMPLE_TAG = re.compile(r"</?[A-Za-z][^<>]*>")
+# markup that the simple tag stripper can't handle correctly
+COMPLEX_HTML = re.compile(r"<\s*(script|style)\b|<!--|<!\[CDATA\[", flags=re.I)
+
+# set in each worker of the process pool by init_worker
+_worker_cloze_input_parser = None
+
+
+@lru_cache(maxsize=None)
+def cloze_pattern(cord):
+    """
+    Compiled pattern matching the clozes of every ordinal except cord.
+    """
+    remaining_digits = "".join([str(x) for x in range(0, 10) if int(x) != cord])
+    return re.compile(
+        "{{" + f"c[{remaining_digits}]::(.*?)" + "}}",
+        flags=re.DOTALL | re.M,
+    )
+
+
+def html_to_text(content):
+    """
+    Strip the html tags and unescape the entities, only using BeautifulSoup
+    when the content contains markup that a regex can't strip reliably.
+    """
+    if "<" not in content and "&" not in content:
+        return content
+    if COMPLEX_HTML.search(content) is None:
+        text = SIMPLE_TAG.sub("", content)
+        if "<" not in text and ">" not in text:
+            return html.unescape(text)
+    return BeautifulSoup(content, "html.parser").get_text()
+
+
+def format_card(fields, ord, field_names, note_mode, cloze_input_parser=None):
+    """
+    Turn the fields of a card into the text sent to the LLM.
+
+    Parameters
+    ----------
+    fields : dict
+        'fields' of the card as returned by cardsInfo
+    ord : int
+        ordinal of the card
+    field_names : list of str
+        fields to include
+    note_mode : bool
+        if True all the clozes are removed, otherwise only the ones of the
+        other cards of the note
+    cloze_input_parser : callable, default None
+        optional user formatting function
+
+    Returns
+    -------
+    tuple
+        (original content, formatted content)
+    """
+    content = ""
+    for fn in field_names:
+        content += f"\n{fn.title()}: {fields[fn]['value'].strip()}"
+    content = content.strip()
+    orig_content = content
+
+    content, _ = replace_media(
+        content=content,
+        media=None,
+        mode="remove_media")
+
+    # light formatting
+    if cloze_input_parser is not None:
+        content = cloze_input_parser(content)
+
+    if not note_mode:
+        content = cloze_pattern(int(ord) + 1).sub(r"\1", content)
+    else:
+        content = ALL_CLOZES.sub(r"\1", content)
+
+    content = content.replace("<br>", "\n").replace("<br/>", "\n")
+    content = content.replace("\r", "\n")
+    content = content.replace(" }}\n", "}}\n")
+
+    return orig_content, html_to_text(content)
+
+
+def init_worker(string_formatting):
+    "load the user formatting function in a worker of the process pool"
+    global _worker_cloze_input_parser
+    if string_formatting is not None:
+        _worker_cloze_input_parser = load_formatting_funcs(
+            path=string_formatting,
+            func_names=["cloze_input_parser"]
+        )[0]
+
+
+def format_card_worker(args):
+    "format_card for the process pool, args is (fields, ord, field_names, note_mode)"
+    return format_card(*args, cloze_input_parser=_worker_cloze_input_parser)
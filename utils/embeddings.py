@@ -0,0 +1,137 @@
+"""
+Embedding index of the few-shot examples of a dataset.
+
+The examples are embedded once and persisted to disk, selecting the
+examples for a card is then a single matrix product followed by a top-k
+that fits in the token budget.
+"""
+import hashlib
+import json
+from pathlib import Path
+
+import litellm
+import numpy as np
+
+from utils.llm import tkn_len
+
+
+class ExampleIndex:
+    """
+    Index over the (user, assistant) example pairs of a dataset.
+
+    The dataset is expected to be a list of messages starting with the
+    system prompt followed by alternating user and assistant messages,
+    as returned by load_dataset.
+    """
+
+    def __init__(self, dataset, embedding_model, cache_dir, batch_size=256, whi=print, red=print):
+        """
+        Parameters
+        ----------
+        dataset : list of dict
+            messages of the dataset
+        embedding_model : str
+            embedding model to use, in litellm format
+        cache_dir : str or Path
+            directory where the embeddings are persisted
+        batch_size : int, default 256
+            number of texts sent per embedding request
+        whi, red : callable
+            loggers
+        """
+        assert dataset[0]["role"] == "system", "Dataset must start with a system prompt"
+        self.embedding_model = embedding_model
+        self.batch_size = batch_size
+        self.whi = whi
+        self.red = red
+
+        self.system = dataset[0]
+        self.pairs = []
+        for i in range(1, len(dataset) - 1, 2):
+            user, assistant = dataset[i], dataset[i + 1]
+            assert user["role"] == "user", f"Expected user message at index {i}"
+            assert assistant["role"] == "assistant", f"Expected assistant message at index {i+1}"
+            self.pairs.append((user, assistant))
+        self.system_len = tkn_len([self.system])
+        self.pair_lens = np.array([tkn_len(list(p)) for p in self.pairs], dtype=np.int64)
+
+        digest = hashlib.sha256(
+            json.dumps(
+                {"dataset": dataset, "embedding_model": embedding_model},
+                sort_keys=True,
+                ensure_ascii=False,
+            ).encode()
+        ).hexdigest()[:16]
+        self.path = Path(cache_dir) / f"example_index_{digest}.npy"
+
+        if self.path.exists():
+            whi(f"Loading example embeddings from '{self.path}'")
+            self.matrix = np.load(self.path)
+            assert len(self.matrix) == len(self.pairs), "Invalid example index size"
+        else:
+            whi(f"Embedding {len(self.pairs)} examples")
+            self.matrix = self.embed([p[0]["content"] for p in self.pairs])
+            np.save(self.path, self.matrix)
+
+    def embed(self, texts):
+        """
+        Embed texts in batches and return the L2 normalized float32 matrix.
+        """
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = texts[start:start + self.batch_size]
+            response = litellm.embedding(model=self.embedding_model, input=batch)
+            vectors.extend(d["embedding"] for d in response.data)
+        matrix = np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return matrix / norms
+
+    def select(self, query, max_token, query_embedding=None):
+        """
+        Return the system prompt followed by the most similar examples
+        that fit, together with the query, in max_token. The selected
+        examples keep their order of the dataset.
+
+        Parameters
+        ----------
+        query : str
+            content of the user message to answer
+        max_token : int
+            token budget of the whole prompt, query included
+        query_embedding : np.ndarray, default None
+            precomputed normalized embedding of the query
+        """
+        if query_embedding is None:
+            query_embedding = self.embed([query])[0]
+        budget = max_token - self.system_len - tkn_len([{"role": "user", "content": query}])
+        if budget < 0:
+            self.red("Query does not fit in the token budget with the system prompt")
+            return [dict(self.system)]
+
+        sims = self.matrix @ query_embedding
+        order = np.argsort(-sims, kind="stable")
+        # keep the most similar pairs as long as the cumulated length fits
+        n_fit = int((np.cumsum(self.pair_lens[order]) <= budget).sum())
+        chosen = np.sort(order[:n_fit])
+
+        messages = [dict(self.system)]
+        for i in chosen:
+            messages.extend(dict(m) for m in self.pairs[i])
+        return messages
+
+    def select_prefix(self, query, max_token):
+        """
+        Return the system prompt followed by the examples in the order of
+        the dataset, as many as fit with the query in max_token.
+
+        Unlike select, the result doesn't depend on the query other than
+        by its length, so consecutive prompts share the same prefix and
+        can benefit from the prompt caching of the providers.
+        """
+        budget = max_token - self.system_len - tkn_len([{"role": "user", "content": query}])
+        n_fit = int((np.cumsum(self.pair_lens) <= budget).sum())
+        messages = [dict(self.system)]
+        for user, assistant in self.pairs[:n_fit]:
+            messages.extend([dict(user), dict(assistant)])
+        return messages
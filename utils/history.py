@@ -0,0 +1,174 @@
+"""
+Append-only storage for the explainer history.
+
+Each line of the file is a json object of the form
+{"cid": "<card id>", "entry": {...}} so that saving a new explanation only
+costs appending one line instead of re-serializing the whole history.
+"""
+import json
+import os
+import threading
+from pathlib import Path
+
+
+class HistoryStore:
+    """
+    JSONL backed mapping of card id (as str) to the list of its history
+    entries.
+
+    The mapping itself is only loaded from disk the first time it is
+    needed, iterating over the entries (for example to sum the spending)
+    streams the file instead.
+    """
+
+    def __init__(self, path, compact_every=1000, red=print):
+        """
+        Parameters
+        ----------
+        path : str or Path
+            path to the jsonl file
+        compact_every : int, default 1000
+            number of appended entries after which the file is compacted
+        red : callable, default print
+            logger used to report malformed lines
+        """
+        self.path = Path(path)
+        self.compact_every = compact_every
+        self.red = red
+        self._records = None
+        self._n_appended = 0
+        self._tail_checked = False
+        self._lock = threading.Lock()
+
+    def migrate(self, legacy_path):
+        """
+        One-shot conversion of the legacy history json file (a single dict
+        of cid to list of entries) to the jsonl format. The legacy file is
+        renamed with a '.migrated' suffix once done.
+
+        Parameters
+        ----------
+        legacy_path : str or Path
+            path to the legacy json file
+
+        Returns
+        -------
+        bool
+            True if a migration took place
+        """
+        legacy_path = Path(legacy_path)
+        if not legacy_path.exists() or self.path.exists():
+            return False
+        legacy = json.load(legacy_path.open())
+        assert isinstance(legacy, dict), "Legacy history is not a dict"
+        self._write_all(
+            (cid, entry) for cid, hist in legacy.items() for entry in hist
+        )
+        legacy_path.rename(legacy_path.with_name(legacy_path.name + ".migrated"))
+        return True
+
+    def iter_entries(self):
+        """
+        Stream the (cid, entry) pairs from disk without loading the whole
+        history in memory. Malformed lines (for example the last line of
+        a crashed run) are skipped.
+        """
+        if not self.path.exists():
+            return
+        with self.path.open() as f:
+            for i, line in enumerate(f):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                    yield str(record["cid"]), record["entry"]
+                except Exception as err:
+                    self.red(f"Skipping malformed history line #{i}: '{err}'")
+
+    def append(self, cid, entry):
+        """
+        Append a new history entry for a card and compact the file if
+        enough entries were appended since the last compaction.
+
+        Parameters
+        ----------
+        cid : str
+            card id
+        entry : dict
+            history entry
+        """
+        cid = str(cid)
+        line = json.dumps({"cid": cid, "entry": entry}, ensure_ascii=False)
+        with self._lock:
+            # a crash can leave a truncated last line, don't append to it
+            needs_newline = False
+            if not self._tail_checked:
+                if self.path.exists() and self.path.stat().st_size:
+                    with self.path.open("rb") as f:
+                        f.seek(-1, os.SEEK_END)
+                        needs_newline = f.read(1) != b"\n"
+                self._tail_checked = True
+            with self.path.open("a") as f:
+                if needs_newline:
+                    f.write("\n")
+                f.write(line + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            if self._records is not None:
+                self._records.setdefault(cid, []).append(entry)
+            self._n_appended += 1
+            if self.compact_every and self._n_appended >= self.compact_every:
+                self._compact()
+
+    def compact(self):
+        """
+        Rewrite the file with the entries grouped by card id and without
+        malformed lines.
+        """
+        with self._lock:
+            self._compact()
+
+    def _compact(self):
+        records = {}
+        for cid, entry in self.iter_entries():
+            records.setdefault(cid, []).append(entry)
+        self._write_all(
+            (cid, entry) for cid, hist in records.items() for entry in hist
+        )
+        self._n_appended = 0
+
+    def _write_all(self, pairs):
+        "write to a temporary file then rename it to avoid corruption"
+        temp_path = self.path.with_name(self.path.name + "_temp")
+        with temp_path.open("w") as f:
+            for cid, entry in pairs:
+                f.write(
+                    json.dumps({"cid": str(cid), "entry": entry}, ensure_ascii=False)
+                    + "\n"
+                )
+            f.flush()
+            os.fsync(f.fileno())
+        temp_path.replace(self.path)
+
+    @property
+    def records(self):
+        "dict of cid to list of entries, loaded on first access"
+        if self._records is None:
+            records = {}
+            for cid, entry in self.iter_entries():
+                records.setdefault(cid, []).append(entry)
+            self._records = records
+        return self._records
+
+    def __contains__(self, cid):
+        return str(cid) in self.records
+
+    def __getitem__(self, cid):
+        return self.records[str(cid)]
+
+    def __len__(self):
+        return len(self.records)
+
+    def items(self):
+        return self.records.items()
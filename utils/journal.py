@@ -0,0 +1,124 @@
+"""
+Journal of an explainer run, used to resume an interrupted run.
+
+The journal is a jsonl file of events:
+    "start"     parameters of the run and card ids returned by findCards
+    "fetched"   card ids whose cardsInfo were fetched and filtered
+    "queued"    formatted cards that are about to be explained
+    "explained" LLM response received for a card
+    "written"   card ids whose note was edited in Anki
+The file is deleted when the run finishes.
+"""
+import json
+import os
+import threading
+from pathlib import Path
+
+from utils.cache import response_to_dict
+
+
+class RunJournal:
+    """
+    Append-only journal of the progress of a run.
+    """
+
+    def __init__(self, path, red=print):
+        """
+        Parameters
+        ----------
+        path : str or Path
+            path to the jsonl file
+        red : callable
+            logger
+        """
+        self.path = Path(path)
+        self.red = red
+        self._lock = threading.Lock()
+
+    def _write(self, event, **values):
+        with self._lock:
+            with self.path.open("a") as f:
+                f.write(json.dumps({"event": event, **values}, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def load(self, params):
+        """
+        Read the journal of an interrupted run.
+
+        Parameters
+        ----------
+        params : dict
+            parameters of the current run, the journal is only used if
+            they are the same as the ones of the interrupted run
+
+        Returns
+        -------
+        dict or None
+            None if there is nothing to resume, otherwise a dict with:
+            "failed" the card ids found by the interrupted run,
+            "fetched" the set of card ids already fetched,
+            "pending" the queued cards not yet written, in order,
+            "notes" the set of note ids of all the queued cards,
+            "responses" dict of cid to the responses received for them.
+        """
+        if not self.path.exists():
+            return None
+        state = None
+        queued = {}
+        responses = {}
+        written = set()
+        fetched = set()
+        with self.path.open() as f:
+            for i, line in enumerate(f):
+                try:
+                    record = json.loads(line)
+                except Exception as err:
+                    self.red(f"Skipping malformed journal line #{i}: '{err}'")
+                    continue
+                event = record["event"]
+                if event == "start":
+                    state = record
+                elif event == "fetched":
+                    fetched.update(record["cids"])
+                elif event == "queued":
+                    for card in record["cards"]:
+                        queued[str(card["cardId"])] = card
+                elif event == "explained":
+                    responses[record["cid"]] = record["response"]
+                elif event == "written":
+                    written.update(record["cids"])
+
+        if state is None or state["params"] != params:
+            self.red("Ignoring the journal of a run with different parameters")
+            return None
+        return {
+            "failed": state["failed"],
+            "fetched": fetched,
+            "pending": [c for cid, c in queued.items() if cid not in written],
+            "notes": set(c["note"] for c in queued.values()),
+            "responses": {
+                cid: r for cid, r in responses.items() if cid not in written
+            },
+        }
+
+    def start(self, params, failed):
+        "begin a new journal"
+        self.path.unlink(missing_ok=True)
+        self._write("start", params=params, failed=failed)
+
+    def fetched(self, cids):
+        self._write("fetched", cids=cids)
+
+    def queued(self, cards):
+        self._write("queued", cards=cards)
+
+    def explained(self, cid, response):
+        self._write("explained", cid=str(cid), response=response_to_dict(response))
+
+    def written(self, cids):
+        self._write("written", cids=[str(c) for c in cids])
+
+    def finish(self):
+        "the run completed, nothing to resume"
+        self.path.unlink(missing_ok=True)
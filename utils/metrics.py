@@ -0,0 +1,113 @@
+"""
+Run-level instrumentation of the explainer.
+
+Every event is appended as a json line to a metrics file specific to the
+run, and a summary line is written when the run ends.
+"""
+import json
+import threading
+import time
+from pathlib import Path
+
+
+class RunMetrics:
+    """
+    Thread safe recorder of timing and cost events, with a budget guard.
+    """
+
+    def __init__(self, metrics_dir, max_budget=None, max_runtime=None):
+        """
+        Parameters
+        ----------
+        metrics_dir : str or Path
+            directory where the metrics file of the run is created
+        max_budget : float, default None
+            dollars after which no new LLM call should be dispatched
+        max_runtime : float, default None
+            seconds after which no new LLM call should be dispatched
+        """
+        metrics_dir = Path(metrics_dir)
+        metrics_dir.mkdir(exist_ok=True, parents=True)
+        self.start = time.time()
+        self.path = metrics_dir / f"run_{int(self.start)}.jsonl"
+        self.max_budget = max_budget
+        self.max_runtime = max_runtime
+        self.dollars = 0.0
+        self.events = {}
+        self._lock = threading.Lock()
+
+    def record(self, kind, **values):
+        """
+        Append an event to the metrics file.
+
+        Parameters
+        ----------
+        kind : str
+            type of the event, for example 'llm_call' or 'anki_flush'
+        values : dict
+            json serializable values of the event. The 'dollar_cost' of
+            the 'llm_call' events is added to the spending of the run.
+        """
+        event = {"kind": kind, "time": time.time() - self.start, **values}
+        with self._lock:
+            if kind == "llm_call":
+                self.dollars += values.get("dollar_cost", 0)
+            self.events.setdefault(kind, []).append(values)
+            with self.path.open("a") as f:
+                f.write(json.dumps(event) + "\n")
+
+    def budget_exceeded(self):
+        """
+        Return a string describing why the run is over budget, or an empty
+        string if it is not.
+        """
+        if self.max_budget is not None and self.dollars >= self.max_budget:
+            return f"spent ${self.dollars:.2f} of the ${self.max_budget:.2f} budget"
+        elapsed = time.time() - self.start
+        if self.max_runtime is not None and elapsed >= self.max_runtime:
+            return f"ran for {elapsed:.0f}s of the {self.max_runtime:.0f}s allowed"
+        return ""
+
+    @staticmethod
+    def _stats(values):
+        "mean, median and 95th percentile of a list of numbers"
+        if not values:
+            return {}
+        values = sorted(values)
+        return {
+            "mean": sum(values) / len(values),
+            "p50": values[len(values) // 2],
+            "p95": values[min(len(values) - 1, int(len(values) * 0.95))],
+        }
+
+    def summary(self):
+        """
+        Compute the summary of the run and append it to the metrics file.
+
+        Returns
+        -------
+        dict
+        """
+        with self._lock:
+            calls = self.events.get("llm_call", [])
+            paid = [c for c in calls if not c.get("cache_hit")]
+            output_tokens = sum(c["output_tokens"] for c in paid)
+            llm_time = sum(c["llm_latency"] for c in paid)
+            cards = len(self.events.get("card_written", []))
+            summary = {
+                "elapsed": time.time() - self.start,
+                "llm_calls": len(calls),
+                "cache_hits": len(calls) - len(paid),
+                "skipped": len(self.events.get("skipped", [])),
+                "cards_written": cards,
+                "dollar_cost": self.dollars,
+                "dollar_per_card": self.dollars / cards if cards else 0,
+                "tokens_per_second": output_tokens / llm_time if llm_time else 0,
+                "queue_wait": self._stats([c["queue_wait"] for c in calls]),
+                "llm_latency": self._stats([c["llm_latency"] for c in paid]),
+                "anki_latency": self._stats(
+                    [c["latency"] for c in self.events.get("anki_flush", [])]
+                ),
+            }
+        self.record("summary", **summary)
+        return summary
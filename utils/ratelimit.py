@@ -0,0 +1,181 @@
+"""
+Client side rate limiting of the LLM calls.
+
+A token bucket per model limits both the requests per minute and the
+tokens per minute, and adapts its rate when the provider still answers
+with rate limit errors. Calls are retried with jittered exponential
+backoff.
+"""
+import random
+import threading
+import time
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def is_rate_limit_error(err):
+    "True if the exception is a rate limit (HTTP 429) error"
+    if getattr(err, "status_code", None) == 429:
+        return True
+    return "ratelimit" in type(err).__name__.lower() or "429" in str(err)
+
+
+class RateLimiter:
+    """
+    Token buckets for the requests and tokens per minute of a model.
+
+    The allowed rate is halved (down to min_fraction of the configured
+    limits) on each rate limit error and grows back by 5% of the
+    configured limits on each success.
+    """
+
+    def __init__(self, rpm=None, tpm=None, min_fraction=0.1, output_estimate=500):
+        """
+        Parameters
+        ----------
+        rpm : float, default None
+            requests per minute, None for no limit
+        tpm : float, default None
+            tokens per minute (input and output), None for no limit
+        min_fraction : float, default 0.1
+            lowest fraction of the limits the rate can be reduced to
+        output_estimate : int, default 500
+            initial estimate of the number of output tokens per request,
+            then updated from the actual usage
+        """
+        self.rpm = rpm
+        self.tpm = tpm
+        self.min_fraction = min_fraction
+        self.fraction = 1.0
+        self.output_estimate = output_estimate
+        self._requests = rpm or 0
+        self._tokens = tpm or 0
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last
+        self._last = now
+        if self.rpm:
+            self._requests = min(
+                self.rpm, self._requests + elapsed * self.rpm * self.fraction / 60
+            )
+        if self.tpm:
+            self._tokens = min(
+                self.tpm, self._tokens + elapsed * self.tpm * self.fraction / 60
+            )
+
+    def acquire(self, input_tokens):
+        """
+        Block until a request of input_tokens (plus the estimated output
+        tokens) can be sent.
+
+        Returns
+        -------
+        float
+            seconds spent waiting
+        """
+        t0 = time.monotonic()
+        while True:
+            with self._lock:
+                self._refill()
+                tokens = min(input_tokens + self.output_estimate, self.tpm or 0)
+                wait = 0
+                if self.rpm and self._requests < 1:
+                    wait = (1 - self._requests) * 60 / (self.rpm * self.fraction)
+                if self.tpm and self._tokens < tokens:
+                    wait = max(
+                        wait, (tokens - self._tokens) * 60 / (self.tpm * self.fraction)
+                    )
+                if not wait:
+                    if self.rpm:
+                        self._requests -= 1
+                    if self.tpm:
+                        self._tokens -= tokens
+                    return time.monotonic() - t0
+            time.sleep(wait)
+
+    def set_limits(self, rpm=None, tpm=None):
+        "change the configured limits, the buckets are capped to the new ones"
+        with self._lock:
+            self._refill()
+            if rpm != self.rpm:
+                self._requests = min(self._requests, rpm) if self.rpm and rpm else (rpm or 0)
+                self.rpm = rpm
+            if tpm != self.tpm:
+                self._tokens = min(self._tokens, tpm) if self.tpm and tpm else (tpm or 0)
+                self.tpm = tpm
+
+    def success(self, output_tokens):
+        "record a successful call, updating the output estimate"
+        with self._lock:
+            self.output_estimate = 0.9 * self.output_estimate + 0.1 * output_tokens
+            self.fraction = min(1.0, self.fraction + 0.05)
+
+    def rate_limited(self):
+        "record a rate limit error, halving the allowed rate"
+        with self._lock:
+            self.fraction = max(self.min_fraction, self.fraction / 2)
+            # don't let the bucket burst right after a rate limit error
+            self._requests = min(self._requests, 0)
+            self._tokens = min(self._tokens, 0)
+
+
+def get_limiter(model, rpm=None, tpm=None):
+    """
+    Limiter shared by all the calls to the same model in this process, its
+    limits are updated if they differ from the ones it was created with.
+    """
+    with _limiters_lock:
+        if model not in _limiters:
+            _limiters[model] = RateLimiter(rpm=rpm, tpm=tpm)
+        limiter = _limiters[model]
+    if (limiter.rpm, limiter.tpm) != (rpm, tpm):
+        limiter.set_limits(rpm=rpm, tpm=tpm)
+    return limiter
+
+
+def call_with_retry(func, limiter, input_tokens, max_retries=5, base_delay=1, max_delay=60, red=print):
+    """
+    Call func once the limiter allows it, retrying with jittered
+    exponential backoff on errors.
+
+    Parameters
+    ----------
+    func : callable
+        function without arguments returning the response
+    limiter : RateLimiter
+    input_tokens : int
+        estimated number of input tokens of the request
+    max_retries : int, default 5
+    base_delay : float, default 1
+        delay before the first retry, doubled at each retry
+    max_delay : float, default 60
+    red : callable
+        logger
+
+    Returns
+    -------
+    tuple
+        (response, seconds spent waiting for the limiter or backing off)
+    """
+    waited = 0
+    for attempt in range(max_retries + 1):
+        waited += limiter.acquire(input_tokens)
+        try:
+            response = func()
+        except Exception as err:
+            if attempt == max_retries:
+                raise
+            if is_rate_limit_error(err):
+                limiter.rate_limited()
+            # full jitter
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            red(f"LLM call failed ({err}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+            waited += delay
+            continue
+        limiter.success(response["usage"]["completion_tokens"])
+        return response, waited
@@ -0,0 +1,65 @@
+"""
+Background worker for side effects (notifications, syncing) that should
+not block the main loop.
+"""
+import queue
+import threading
+import traceback
+
+
+class BackgroundWorker:
+    """
+    Single thread executing the submitted tasks in order.
+
+    Exceptions raised by a task don't stop the worker, they are passed to
+    on_error.
+    """
+
+    def __init__(self, on_error=None, name="background-worker"):
+        """
+        Parameters
+        ----------
+        on_error : callable, default None
+            called with the task name and the formatted traceback when a
+            task fails
+        name : str
+            name of the thread
+        """
+        self.on_error = on_error
+        self.errors = []
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                self._queue.task_done()
+                return
+            name, func, args, kwargs = task
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                tb = traceback.format_exc()
+                self.errors.append((name, tb))
+                if self.on_error is not None:
+                    try:
+                        self.on_error(name, tb)
+                    except Exception:
+                        traceback.print_exc()
+            finally:
+                self._queue.task_done()
+
+    def submit(self, name, func, *args, **kwargs):
+        "queue func(*args, **kwargs), name is used when reporting errors"
+        assert self._thread.is_alive(), "Worker already drained"
+        self._queue.put((name, func, args, kwargs))
+
+    def drain(self):
+        "wait for all the queued tasks then stop the thread"
+        if not self._thread.is_alive():
+            return
+        self._queue.put(None)
+        self._queue.join()
+        self._thread.join()